@@ -1,3 +1,5 @@
+import threading
+
 # Function to convert numbers to letters (1->A, 2->B, ... 26->Z, 27->AA, 28->AB...)
 
 
@@ -73,6 +75,611 @@ def load_credentials():
     print('credentials loaded')
     return acc,sh,em,post,ho,use,wo,database,go,look,look_sec
 
+
+
+# Google API client pool, kept for the life of the process so sheet operations reuse tokens and
+# keep-alive connections instead of re-authorizing on every call
+GOOGLE_API_SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+_google_pool_lock = threading.Lock()
+_google_credentials = {}
+_discovery_documents = {}
+_google_services = threading.local()
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _google_pool_key(json_data, scopes):
+    return (json_data.get('client_email'), json_data.get('private_key_id'), tuple(scopes))
+
+
+def get_google_credentials(json_data, scopes=GOOGLE_API_SCOPES):
+    from google.oauth2 import service_account
+
+    key = _google_pool_key(json_data, scopes)
+    with _google_pool_lock:
+        if key not in _google_credentials:
+            _google_credentials[key] = service_account.Credentials.from_service_account_info(json_data, scopes=scopes)
+        return _google_credentials[key]
+
+
+def get_discovery_document(service_name, version):
+    #Discovery documents are fetched once per process and shared, every thread builds its service objects from the
+    #cached copy instead of downloading it again. Tries the same two discovery URLs as googleapiclient's build
+    from googleapiclient.discovery import DISCOVERY_URI, V2_DISCOVERY_URI
+    from googleapiclient.http import build_http
+
+    key = (service_name, version)
+    with _google_pool_lock:
+        if key not in _discovery_documents:
+            for uri in (DISCOVERY_URI, V2_DISCOVERY_URI):
+                response, content = build_http().request(uri.format(api=service_name, apiVersion=version))
+                if response.status < 400:
+                    _discovery_documents[key] = content.decode('utf-8')
+                    break
+            else:
+                raise ValueError('No discovery document found for {} {}: HTTP {}'.format(service_name, version, response.status))
+        return _discovery_documents[key]
+
+
+def get_google_service(service_name, version, json_data, scopes=GOOGLE_API_SCOPES):
+    #httplib2 connections are not thread safe, so each thread keeps its own service objects on top of the
+    #shared credentials and discovery document
+    import google_auth_httplib2
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import build_http
+
+    services = getattr(_google_services, 'services', None)
+    if services is None:
+        services = _google_services.services = {}
+    key = (service_name, version) + _google_pool_key(json_data, scopes)
+    if key not in services:
+        creds = get_google_credentials(json_data, scopes)
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+        services[key] = build_from_document(get_discovery_document(service_name, version), http=http)
+    return services[key]
+
+
+def get_executor(name, max_workers):
+    #Worker pools live as long as the process, so their threads, and the per-thread service objects and keep-alive
+    #connections above, are reused by every read, write and import instead of being rebuilt for each call
+    from concurrent.futures import ThreadPoolExecutor
+
+    key = (name, max_workers)
+    with _executors_lock:
+        if key not in _executors:
+            _executors[key] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        return _executors[key]
+
+
+def dataframe_to_values(df, header=None):
+    #Row-major 2D list of cell values for the Sheets API, one pass per column instead of one per row.
+    #Same rules as the old per-cell loop: nulls -> "", float columns -> float, int columns -> int, anything else -> str
+    import numpy as np
+    import pandas as pd
+
+    if len(df.columns) == 0:
+        values = [[] for row in range(len(df))]
+    else:
+        columns = []
+        for name in df.columns:
+            column = df[name]
+            nulls = column.isna().to_numpy()
+            if pd.api.types.is_float_dtype(column.dtype) or pd.api.types.is_integer_dtype(column.dtype):
+                column_values = column.to_numpy(dtype=object)
+            else:
+                column_values = column.astype(object).astype(str).to_numpy(dtype=object)
+            column_values[nulls] = ""
+            columns.append(column_values)
+        values = np.column_stack(columns).tolist()
+    if header is not None:
+        values.insert(0, list(header))
+    return values
+
+
+# Day zero of the serial numbers Sheets returns for dates with dateTimeRenderOption=SERIAL_NUMBER
+SHEETS_SERIAL_EPOCH = '1899-12-30'
+
+
+def serial_number_to_datetime(series):
+    #Serial day counts to datetime64 in one step. Cells holding a date typed as text fall back to pd.to_datetime on
+    #the string, blanks become NaT
+    import numpy as np
+    import pandas as pd
+
+    values = series.replace("", np.nan)
+    numbers = pd.to_numeric(values, errors='coerce')
+    result = pd.to_datetime(numbers, unit='D', origin=SHEETS_SERIAL_EPOCH)
+    text = values.notna() & numbers.isna()
+    if text.any():
+        result[text] = pd.to_datetime(values[text].astype(str))
+    return result
+
+
+PARSE_SAMPLE_ROWS = 1000
+
+
+def parse_column_values(series, parse_uniques):
+    #Sheet columns repeat a lot (spot counts, rates, blanks), so parse each distinct value once with parse_uniques
+    #(object Series in, Series of results out, nulls included) and spread the results back over the column with a
+    #NumPy take. Columns that look mostly unique from their first rows are parsed directly instead.
+    import numpy as np
+    import pandas as pd
+
+    sample = series.iloc[:PARSE_SAMPLE_ROWS]
+    if len(series) > PARSE_SAMPLE_ROWS and sample.nunique(dropna=False) > len(sample) // 2:
+        parsed = parse_uniques(series.astype(object))
+        return pd.Series(parsed.to_numpy(dtype=object), index=series.index, name=series.name).infer_objects()
+
+    codes, uniques = pd.factorize(series)
+    parsed = parse_uniques(pd.Series(uniques, dtype=object))
+    values = np.append(parsed.to_numpy(dtype=object), np.nan)
+    return pd.Series(values[codes], index=series.index, name=series.name).infer_objects()
+
+
+def parse_currency_column(series, keep_numbers=False):
+    #Vectorized form of the order cleanup x.replace(',','').replace("$","") if type(x) == str else np.NaN followed
+    #by astype(float): text has ',' and '$' stripped and must then parse ("#N/A" still raises), blanks become NaN.
+    #With keep_numbers (UNFORMATTED_VALUE reads) numeric cells pass through instead of becoming NaN.
+    import numpy as np
+    import pandas as pd
+
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in ('floating', 'integer', 'mixed-integer-float', 'empty'):
+        #Typed reads of a clean column, nothing to parse
+        if keep_numbers or kind == 'empty':
+            return series.astype(float)
+        return pd.Series(np.nan, index=series.index, name=series.name, dtype=float)
+
+    def parse_uniques(uniques):
+        result = pd.Series(np.nan, index=uniques.index, dtype=float)
+        values = uniques.to_numpy(dtype=object)
+        is_text = np.array([type(value) is str for value in values], dtype=bool)
+        if keep_numbers and (~is_text).any():
+            result[~is_text] = pd.to_numeric(uniques[~is_text]).astype(float)
+        text = is_text & (values != "")
+        if text.any():
+            result[text] = [float(value.replace(',', '').replace('$', '')) for value in values[text]]
+        return result
+
+    return parse_column_values(series, parse_uniques).astype(float)
+
+
+def parse_percentage_column(series):
+    #Vectorized form of the budget percentage_converter: ints and floats are kept as they are, anything else is
+    #reduced to its digits and '.', divided by 100 when it contained '%', and NaN when that does not parse
+    #(blanks, "#N/A", text).
+    import numpy as np
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return series.copy()
+    if pd.api.types.infer_dtype(series, skipna=True) in ('floating', 'integer', 'mixed-integer-float', 'empty'):
+        return series.replace([None], np.nan).infer_objects()
+
+    def parse_uniques(uniques):
+        result = uniques.copy()
+        text = ~uniques.map(type).isin([int, float]).values
+        if text.any():
+            strings = uniques[text].astype(str)
+            digits = strings.str.replace('[^0-9.]', '', regex=True)
+            #Exactly the strings float() accepts once everything but digits and '.' is gone
+            valid = digits.str.match(r'^(\d+\.?\d*|\.\d+)$').values
+            parsed = pd.Series(np.nan, index=strings.index, dtype=float)
+            parsed[valid] = digits[valid].astype(float)
+            percent = strings.str.contains('%', regex=False).values
+            parsed[percent] = parsed[percent] / 100
+            result[text] = parsed.values
+        return result
+
+    return parse_column_values(series, parse_uniques)
+
+
+def spreadsheet_id_from_url(url):
+    import re
+
+    match = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", str(url))
+    if match:
+        return match.group(1)
+    return None
+
+
+def quote_tab_name(tab_name):
+    return "'" + tab_name.replace("'", "''") + "'"
+
+
+def get_tab_properties(spreadsheet_id, tab_name, json_data):
+    service = get_google_service('sheets', 'v4', json_data)
+    response = execute_sheets_request(lambda: service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        ranges=[quote_tab_name(tab_name)],
+        fields='sheets(properties(sheetId,title,gridProperties(rowCount,columnCount)))'))
+    return response['sheets'][0]['properties']
+
+
+def get_workbook_tabs(spreadsheet_id, json_data):
+    #One metadata call for the whole workbook: tab title -> properties (sheetId, index, gridProperties)
+    service = get_google_service('sheets', 'v4', json_data)
+    response = execute_sheets_request(lambda: service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields='sheets(properties(sheetId,title,index,gridProperties(rowCount,columnCount)))'))
+    return dict((sheet['properties']['title'], sheet['properties']) for sheet in response.get('sheets', []))
+
+
+def add_tab(spreadsheet_id, tab_name, rows, columns, json_data):
+    service = get_google_service('sheets', 'v4', json_data)
+    execute_sheets_request(lambda: service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={'requests': [{'addSheet': {'properties': {'title': tab_name, 'gridProperties': {'rowCount': rows, 'columnCount': columns}}}}]}),
+        quota='write')
+
+
+def pad_values(values):
+    #The values API drops trailing empty cells, pad every row to the widest one like gspread's get_all_values does
+    width = max([len(row) for row in values] + [0])
+    return [list(row) + [""] * (width - len(row)) for row in values]
+
+
+def values_to_frame(values):
+    #First row is the header, like pd.DataFrame(list_of_values[1:], columns=list_of_values[0])
+    import pandas as pd
+
+    if not values:
+        return pd.DataFrame()
+    return pd.DataFrame(values[1:], columns=values[0])
+
+
+def read_workbook_values(spreadsheet_id, tab_names, json_data, tabs=None, value_render_option='FORMATTED_VALUE'):
+    #Every cell of each tab in tab_names with a single values.batchGet, returned as tab name -> padded 2D list.
+    #tabs is the get_workbook_tabs metadata, fetched here when the caller does not already have it
+    if tabs is None:
+        tabs = get_workbook_tabs(spreadsheet_id, json_data)
+    missing = [tab_name for tab_name in tab_names if tab_name not in tabs]
+    if missing:
+        raise ValueError('Tab(s) not found in spreadsheet {}: {}'.format(spreadsheet_id, ', '.join(missing)))
+
+    service = get_google_service('sheets', 'v4', json_data)
+    response = execute_sheets_request(lambda: service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=[quote_tab_name(tab_name) for tab_name in tab_names],
+        valueRenderOption=value_render_option,
+        majorDimension='ROWS'))
+    value_ranges = response.get('valueRanges', [])
+    return dict((tab_name, pad_values(value_range.get('values', []))) for tab_name, value_range in zip(tab_names, value_ranges))
+
+
+def read_workbook_frames(spreadsheet_id, tab_names, json_data, tabs=None, value_render_option='FORMATTED_VALUE'):
+    #read_workbook_values with every tab turned into a DataFrame, header row as the columns
+    values = read_workbook_values(spreadsheet_id, tab_names, json_data, tabs, value_render_option)
+    return dict((tab_name, values_to_frame(tab_values)) for tab_name, tab_values in values.items())
+
+
+def column_spans(indices):
+    #Sorted, merged (first, last) runs of 0-based column indices, so adjacent columns share one range
+    spans = []
+    for index in sorted(set(indices)):
+        if spans and index == spans[-1][1] + 1:
+            spans[-1][1] = index
+        else:
+            spans.append([index, index])
+    return [tuple(span) for span in spans]
+
+
+def resolve_columns(tab_name, header, columns):
+    #columns is a list of header names and/or 0-based column indices, an int for the first n columns, or None for
+    #every column in the header
+    if columns is None:
+        return list(range(len(header)))
+    if isinstance(columns, int):
+        return list(range(columns))
+    missing = [column for column in columns if not isinstance(column, int) and column not in header]
+    if missing:
+        raise ValueError('Column(s) not found in tab {}: {}'.format(tab_name, ', '.join(missing)))
+    return [column if isinstance(column, int) else header.index(column) for column in columns]
+
+
+# Tabs with more grid rows than SHEETS_READ_WINDOW_ROWS are read as row windows of that size, up to
+# SHEETS_READ_MAX_WORKERS at a time, instead of one huge response that can take minutes or time out
+SHEETS_READ_WINDOW_ROWS = 20000
+SHEETS_READ_MAX_WORKERS = 4
+
+
+def read_workbook_columns(spreadsheet_id, tab_columns, json_data, value_render_option='FORMATTED_VALUE', date_time_render_option=None,
+                          formatted_columns=None, window_rows=SHEETS_READ_WINDOW_ROWS, max_workers=SHEETS_READ_MAX_WORKERS):
+    #Projected version of read_workbook_frames. tab_columns maps tab name -> columns (see resolve_columns). The
+    #header rows come back with the tab metadata in one spreadsheets.get, then one values.batchGet reads only the
+    #needed column ranges, column-major, so every column stops at its own last populated cell instead of the grid's
+    #last row. Tabs longer than window_rows get one batchGet per row window instead, fetched concurrently under the
+    #shared read rate limiter until the data runs out and stitched back together in order. Returns tab name ->
+    #DataFrame with the columns in the requested order, padded with "" like get_all_values. With
+    #UNFORMATTED_VALUE/SERIAL_NUMBER numbers come back as numbers and dates as serial day counts, see
+    #parse_currency_column and serial_number_to_datetime.
+    #formatted_columns maps tab name -> columns (see resolve_columns) that are text, like codes and names: those are
+    #always read as FORMATTED_VALUE, in a batchGet of their own, so a code such as 01234 keeps its display string.
+    import datetime
+    import pandas as pd
+
+    service = get_google_service('sheets', 'v4', json_data)
+    tab_names = list(tab_columns)
+    response = execute_sheets_request(lambda: service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        ranges=[quote_tab_name(tab_name) + '!1:1' for tab_name in tab_names],
+        fields='sheets(properties(title,gridProperties(rowCount)),data(rowData(values(formattedValue))))'))
+    headers = {}
+    row_counts = {}
+    for sheet in response.get('sheets', []):
+        title = sheet['properties']['title']
+        row_data = (sheet.get('data') or [{}])[0].get('rowData', [])
+        cells = row_data[0].get('values', []) if row_data else []
+        headers[title] = [cell.get('formattedValue', '') for cell in cells]
+        row_counts[title] = sheet['properties'].get('gridProperties', {}).get('rowCount', 0)
+
+    #Each batch is one batchGet with a value render option and a list of (tab, first column, last column, first row,
+    #last row or None for open ended)
+    selected = {}
+    groups = {}
+    small_tabs = {}
+    next_window = {}
+    for tab_name in tab_names:
+        header = headers.get(tab_name, [])
+        selected[tab_name] = resolve_columns(tab_name, header, tab_columns[tab_name])
+        text_indices = set(resolve_columns(tab_name, header, (formatted_columns or {}).get(tab_name, [])))
+        if value_render_option == 'FORMATTED_VALUE':
+            text_indices = set()
+        tab_groups = [(value_render_option, [index for index in selected[tab_name] if index not in text_indices]),
+                      ('FORMATTED_VALUE', [index for index in selected[tab_name] if index in text_indices])]
+        groups[tab_name] = [(render_option, column_spans(indices)) for render_option, indices in tab_groups if indices]
+        if row_counts.get(tab_name, 0) - 1 > window_rows:
+            next_window[tab_name] = 2
+        else:
+            for render_option, spans in groups[tab_name]:
+                small_tabs.setdefault(render_option, []).extend((tab_name, first, last, 2, None) for first, last in spans)
+
+    def fetch(batch):
+        render_option, ranges = batch
+        batch_service = get_google_service('sheets', 'v4', json_data)
+        options = {'valueRenderOption': render_option, 'majorDimension': 'COLUMNS'}
+        if date_time_render_option is not None and render_option != 'FORMATTED_VALUE':
+            options['dateTimeRenderOption'] = date_time_render_option
+        return execute_sheets_request(lambda: batch_service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=[quote_tab_name(tab_name) + '!' + numberToLetters(first + 1) + str(start) + ':' + numberToLetters(last + 1) + ('' if end is None else str(end))
+                    for tab_name, first, last, start, end in ranges],
+            **options)).get('valueRanges', [])
+
+    #tab -> column index -> [(row offset, values)], a window past the end of the data returns nothing for a column
+    pieces = dict((tab_name, {}) for tab_name in tab_names)
+    windows_read = dict((tab_name, 0) for tab_name in next_window)
+
+    def collect(batches, results):
+        #Stores the values and returns, per tab, the most rows any column returned in each window
+        window_lengths = {}
+        for (render_option, ranges), value_ranges in zip(batches, results):
+            for (tab_name, first, last, start, end), value_range in zip(ranges, value_ranges):
+                data = value_range.get('values', [])
+                length = max([len(values) for values in data] + [0])
+                if end is not None:
+                    window_lengths.setdefault(tab_name, {})[start] = max(window_lengths.get(tab_name, {}).get(start, 0), length)
+                for index in range(first, min(last + 1, first + len(data))):
+                    if data[index - first]:
+                        pieces[tab_name].setdefault(index, []).append((start - 2, data[index - first]))
+        return window_lengths
+
+    #The grid's rowCount can be far larger than the data (ensure_tab_size and manual resizes only ever grow it), so
+    #long tabs are read in rounds of up to max_workers windows per tab until the last window of a round comes back
+    #with nothing in any column. A short window is not the end: blank rows at a window boundary are trimmed off it.
+    #At most max_workers windows past the end are spent per tab.
+    executor = get_executor('sheets-read', max(1, max_workers))
+    batches = list(small_tabs.items())
+    while batches or next_window:
+        for tab_name, start in list(next_window.items()):
+            row_count = row_counts[tab_name]
+            for window_start in range(start, min(start + max(1, max_workers) * window_rows, row_count + 1), window_rows):
+                for render_option, spans in groups[tab_name]:
+                    batches.append((render_option, [(tab_name, first, last, window_start, min(window_start + window_rows - 1, row_count)) for first, last in spans]))
+                windows_read[tab_name] += 1
+            next_window[tab_name] = start + max(1, max_workers) * window_rows
+        if len(batches) > 1 and max_workers > 1:
+            results = list(executor.map(fetch, batches))
+        else:
+            results = [fetch(batch) for batch in batches]
+        window_lengths = collect(batches, results)
+        for tab_name in list(next_window):
+            last_window = max(window_lengths.get(tab_name, {}) or [0])
+            if window_lengths.get(tab_name, {}).get(last_window, 0) == 0 or next_window[tab_name] > row_counts[tab_name]:
+                print('{} INFO: read_workbook_columns - {}: {} grid rows, read {} window(s) of {}'.format(datetime.datetime.now(), tab_name, row_counts[tab_name], windows_read[tab_name], window_rows))
+                del next_window[tab_name]
+        batches = []
+
+    frames = {}
+    for tab_name in tab_names:
+        indices = selected[tab_name]
+        header = headers.get(tab_name, [])
+        rows = max([offset + len(values) for index in indices for offset, values in pieces[tab_name].get(index, [])] + [0])
+        columns = {}
+        for position, index in enumerate(indices):
+            column = [""] * rows
+            for offset, values in pieces[tab_name].get(index, []):
+                column[offset:offset + len(values)] = values
+            columns[position] = column
+        frame = pd.DataFrame(columns, index=range(rows))
+        frame.columns = [header[index] if index < len(header) else "" for index in indices]
+        frames[tab_name] = frame
+    return frames
+
+
+def ensure_tab_size(spreadsheet_id, tab_properties, rows, columns, json_data):
+    #Grow the tab's grid so a values update of rows x columns fits, the values API does not do it for us
+    service = get_google_service('sheets', 'v4', json_data)
+    grid = tab_properties.get('gridProperties', {})
+    requests = []
+    if rows > grid.get('rowCount', 0):
+        requests.append({'appendDimension': {'sheetId': tab_properties['sheetId'], 'dimension': 'ROWS', 'length': rows - grid.get('rowCount', 0)}})
+    if columns > grid.get('columnCount', 0):
+        requests.append({'appendDimension': {'sheetId': tab_properties['sheetId'], 'dimension': 'COLUMNS', 'length': columns - grid.get('columnCount', 0)}})
+    if requests:
+        execute_sheets_request(lambda: service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}), quota='write')
+
+
+# Values API writes are split into chunks of at most SHEETS_WRITE_CHUNK_CELLS cells (keeps request bodies well under
+# the API's size limit) and sent by up to SHEETS_WRITE_MAX_WORKERS threads. Sheets meters read and write requests
+# against separate per-minute quotas, so each has its own per-process rate limit
+SHEETS_WRITE_CHUNK_CELLS = 40000
+SHEETS_WRITE_MAX_WORKERS = 4
+SHEETS_READ_REQUESTS_PER_MINUTE = 60
+SHEETS_WRITE_REQUESTS_PER_MINUTE = 60
+SHEETS_RETRY_ATTEMPTS = 5
+
+
+class RateLimiter(object):
+    #Spaces calls evenly so no more than rate_per_minute go out per minute across all threads
+
+    def __init__(self, rate_per_minute):
+        self.interval = 60.0 / rate_per_minute
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def acquire(self):
+        import time
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_sheets_rate_limiters = {
+    'read': RateLimiter(SHEETS_READ_REQUESTS_PER_MINUTE),
+    'write': RateLimiter(SHEETS_WRITE_REQUESTS_PER_MINUTE),
+}
+
+
+def get_sheets_rate_limiter(quota='read'):
+    return _sheets_rate_limiters[quota]
+
+
+def execute_sheets_request(make_request, quota='read'):
+    #Run a Sheets API call under the rate limiter of its quota ('read' or 'write'), backing off on quota (429) and
+    #transient 5xx errors. make_request builds the request, so each retry (and each thread) gets a fresh one
+    import time
+    from googleapiclient.errors import HttpError
+
+    rate_limiter = get_sheets_rate_limiter(quota)
+    for attempt in range(SHEETS_RETRY_ATTEMPTS):
+        rate_limiter.acquire()
+        try:
+            return make_request().execute()
+        except HttpError as e:
+            if e.resp.status not in (429, 500, 502, 503, 504) or attempt == SHEETS_RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(min(2 ** attempt, 32))
+
+
+def chunk_value_blocks(tab_name, blocks, max_cells=SHEETS_WRITE_CHUNK_CELLS):
+    #blocks is a list of (first_row, rows) with first_row 1-based and rows a 2D list. Returns a list of chunks, each a
+    #list of {'range', 'values'} entries for one values batchUpdate holding at most max_cells cells; big blocks are
+    #split by rows and small ones are packed together
+    tab = quote_tab_name(tab_name)
+    chunks = []
+    chunk = []
+    chunk_cells = 0
+    for first_row, rows in blocks:
+        width = max([len(row) for row in rows] + [1])
+        rows_per_part = max(1, max_cells // width)
+        for offset in range(0, len(rows), rows_per_part):
+            part = rows[offset:offset + rows_per_part]
+            if chunk and chunk_cells + len(part) * width > max_cells:
+                chunks.append(chunk)
+                chunk = []
+                chunk_cells = 0
+            start = first_row + offset
+            chunk.append({
+                'range': tab + '!A' + str(start) + ':' + numberToLetters(width) + str(start + len(part) - 1),
+                'values': part,
+            })
+            chunk_cells += len(part) * width
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def batch_update_values_chunked(spreadsheet_id, tab_name, blocks, json_data, value_input_option='RAW',
+                                max_cells=SHEETS_WRITE_CHUNK_CELLS, max_workers=SHEETS_WRITE_MAX_WORKERS):
+    #Write plain 2D value blocks (see chunk_value_blocks) through the values API, one batchUpdate per chunk with the
+    #chunks uploaded concurrently. Logs each chunk's size and latency and returns the number of cells written.
+    import datetime
+    import time
+
+    chunks = chunk_value_blocks(tab_name, blocks, max_cells)
+
+    def upload(numbered_chunk):
+        number, chunk = numbered_chunk
+        service = get_google_service('sheets', 'v4', json_data)
+        cells = sum(len(entry['values']) * len(entry['values'][0]) for entry in chunk if entry['values'])
+        started = time.time()
+        execute_sheets_request(lambda: service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'valueInputOption': value_input_option, 'data': chunk}),
+            quota='write')
+        print('{} INFO: batch_update_values_chunked - {}: chunk {}/{}, {} range(s), {} cell(s) in {:.2f}s'.format(
+            datetime.datetime.now(), tab_name, number + 1, len(chunks), len(chunk), cells, time.time() - started))
+        return cells
+
+    if len(chunks) <= 1 or max_workers <= 1:
+        return sum(upload(numbered_chunk) for numbered_chunk in enumerate(chunks))
+    return sum(get_executor('sheets-write', max_workers).map(upload, enumerate(chunks)))
+
+
+def write_tab_diff(spreadsheet_id, tab_name, values, json_data):
+    #Make a tab hold exactly values (2D, header row included) like clear() + update_cells would, but read the tab
+    #once and only send the blocks of rows that differ, through batch_update_values_chunked. Rows past the end of values and
+    #cells right of its width are cleared only if they hold anything. Returns the number of cells sent.
+    import datetime
+
+    service = get_google_service('sheets', 'v4', json_data)
+    tab = quote_tab_name(tab_name)
+    width = max([len(row) for row in values] + [1])
+    current = execute_sheets_request(lambda: service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=tab,
+        valueRenderOption='UNFORMATTED_VALUE',
+        dateTimeRenderOption='FORMATTED_STRING')).get('values', [])
+
+    def padded(row):
+        return list(row[:width]) + [""] * (width - len(row[:width]))
+
+    blocks = []
+    block_start = None
+    for index in range(len(values) + 1):
+        changed = index < len(values) and (index >= len(current) or padded(current[index]) != padded(values[index]))
+        if changed and block_start is None:
+            block_start = index
+        elif not changed and block_start is not None:
+            blocks.append((block_start + 1, [padded(row) for row in values[block_start:index]]))
+            block_start = None
+
+    clear_ranges = []
+    if len(current) > len(values):
+        clear_ranges.append(tab + '!A' + str(len(values) + 1) + ':' + numberToLetters(max([width] + [len(row) for row in current])) + str(len(current)))
+    current_width = max([len(row) for row in current[:len(values)]] + [0])
+    if current_width > width and any(any(cell != "" for cell in row[width:]) for row in current[:len(values)]):
+        clear_ranges.append(tab + '!' + numberToLetters(width + 1) + '1:' + numberToLetters(current_width) + str(len(values)))
+
+    cells_sent = 0
+    if blocks:
+        ensure_tab_size(spreadsheet_id, get_tab_properties(spreadsheet_id, tab_name, json_data), len(values), width, json_data)
+        cells_sent = batch_update_values_chunked(spreadsheet_id, tab_name, blocks, json_data)
+    if clear_ranges:
+        execute_sheets_request(lambda: service.spreadsheets().values().batchClear(
+            spreadsheetId=spreadsheet_id,
+            body={'ranges': clear_ranges}),
+            quota='write')
+
+    print('{} INFO: write_tab_diff - {}: {} changed block(s), {} cell(s) sent, {} range(s) cleared'.format(datetime.datetime.now(), tab_name, len(blocks), cells_sent, len(clear_ranges)))
+    return cells_sent
+
+
 def convert_to_int(x):
 
     if  (type(x) == float):
@@ -1772,45 +2379,22 @@ def gsheet_budget_update(active_client):
         names_df['formatted_smbs'] = names_df['vendor_name'].apply(lambda x: format_strings(x))
         #names_df['formatted_adjusted'] = names_df['adjusted_show_name'].apply(lambda x: format_strings(x))
         names_df['formatted_adjusted'] = names_df['adjusted_show_name'].str.lower()
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
 
 
         def gsheet_budget_upload(url,adjusted_client_ID):
             try:
                 print("getting info for: " + str(adjusted_client_ID))
-                json_datas = go
-                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-                client = gspread.authorize(creds)
-                workbook = client.open_by_url(url)
+                spreadsheet_id = spreadsheet_id_from_url(url)
+                tabs = get_workbook_tabs(spreadsheet_id, go)
 
-                try:
-                    workbook.add_worksheet("Database Names",rows = 4000,cols = 15)
-                except Exception as e:
-                    stuff = 1
+                if "Database Names" not in tabs:
+                    add_tab(spreadsheet_id, "Database Names", 4000, 15, go)
                 #try:
             #        workbook.add_worksheet("Error Report",rows = 4000,cols = 15)
             #    except:
             #        stuff = 1
 
-                sheet = workbook.worksheet("Flowchart")
-                list_of_values = sheet.get_all_values()
-
-                df = pd.DataFrame(data = list_of_values[1:],columns=list_of_values[0])
+                df = read_workbook_frames(spreadsheet_id, ["Flowchart"], go, tabs)["Flowchart"]
                 df['adjusted_client_id'] = adjusted_client_ID
                 client_df = names_df[names_df['adjusted_client_id'] == adjusted_client_ID]
                 #Pull in unfomratted name
@@ -1851,16 +2435,9 @@ def gsheet_budget_update(active_client):
                 df['date'] = df['date'].apply(lambda x: pd.to_datetime((x + "/2019").replace("12/31/2019","12/31/2018")))
 
                 df.to_csv(str(adjusted_client_ID) + "_2019.csv",index = False)
-                sheet = workbook.worksheet("Database Names")
-                sheet.clear()
                 client_df = client_df[["estimate_id","estimate_name","vendor_name","adjusted_show_name","vendor_id"]]
                 client_df = client_df.sort_values(by='adjusted_show_name')
-                cell_range = sheet.range("A1:E"+ str(len(client_df) + 1))
-                df_as_list = ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"] + client_df.replace(np.NaN,"").values.flatten().tolist()
-                count = 0
-                for index,cell in enumerate(cell_range):
-                    cell.value = df_as_list[index]
-                sheet.update_cells(cell_range)
+                write_tab_diff(spreadsheet_id, "Database Names", dataframe_to_values(client_df, ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"]), go)
 
 
 
@@ -1891,7 +2468,7 @@ def gsheet_budget_update(active_client):
                 spot_placement_errors.rename(columns={'spot_placement':'error'},inplace=True)
                 spot_placement_errors.fillna("Blank",inplace = True)
                 spot_placement_errors['error'] = spot_placement_errors['error'].apply(lambda x: x + " is not an approved value for this column")
-                df['num_spot'] = df['num_spot'].apply(lambda x: percentage_converter(x))
+                df['num_spot'] = parse_percentage_column(df['num_spot'])
                 #df = df[df['num_spot'] > 0]
                 non_match_errors = df[df['master_vendor_id'].isna()][['roll_up_show','show_detail']].drop_duplicates()
                 non_match_errors['error_column'] = "Roll up - Show"
@@ -1996,26 +2573,11 @@ on act_cli.adjusted_client_id = budg.adjusted_client_id""",engine)
             col_data_type_dict[col] = VARCHAR
         schema = 'gsheet_budgets'
         table_name = 'crazy_gsheet_budget'
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
         for col in ['estimate','downloads_aqh',"cpm","commission",'gross_spot_cost','client_net_spot_cost','gross_tf',
                'client_net_tf','num_spot','master_vendor_id']:
             print(col)
             col_data_type_dict[col] = FLOAT
-            df[col] = df[col].apply(lambda x: percentage_converter(x))
+            df[col] = parse_percentage_column(df[col])
 
 
 
@@ -2876,43 +3438,20 @@ def gsheet_budget_update_2020(active_client):
         names_df['formatted_smbs'] = names_df['vendor_name'].apply(lambda x: format_strings(x))
         #names_df['formatted_adjusted'] = names_df['adjusted_show_name'].apply(lambda x: format_strings(x))
         names_df['formatted_adjusted'] = names_df['adjusted_show_name'].str.lower()
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
         def gsheet_budget_upload(url,adjusted_client_ID):
             try:
                 print("getting info for: " + str(adjusted_client_ID))
-                json_datas = go
-                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-                client = gspread.authorize(creds)
-                workbook = client.open_by_url(url)
+                spreadsheet_id = spreadsheet_id_from_url(url)
+                tabs = get_workbook_tabs(spreadsheet_id, go)
 
-                try:
-                    workbook.add_worksheet("Database Names",rows = 4000,cols = 15)
-                except Exception as e:
-                    stuff = 1
+                if "Database Names" not in tabs:
+                    add_tab(spreadsheet_id, "Database Names", 4000, 15, go)
 #                try:
 #                    workbook.add_worksheet("Error Report",rows = 4000,cols = 15)
 #                except:
 #                    stuff = 1
 
-                sheet = workbook.worksheet("Flowchart")
-                list_of_values = sheet.get_all_values()
-
-                df = pd.DataFrame(data = list_of_values[1:],columns=list_of_values[0])
+                df = read_workbook_frames(spreadsheet_id, ["Flowchart"], go, tabs)["Flowchart"]
                 df = df[(df['Roll Up - Show'] != "") | (df['Roll Up - Show'].notna())]
                 if len(df) > 0:
                     try:
@@ -2958,16 +3497,9 @@ def gsheet_budget_update_2020(active_client):
                     df['date'] = df['date'].apply(lambda x: pd.to_datetime((x + "/2020").replace("12/31/2020","12/31/2019").replace("12/30/2020","12/30/2019")))
 
                     df.to_csv(str(adjusted_client_ID) + "_2020.csv",index = False)
-                    sheet = workbook.worksheet("Database Names")
-                    sheet.clear()
                     client_df = client_df[["estimate_id","estimate_name","vendor_name","adjusted_show_name","vendor_id"]]
                     client_df = client_df.sort_values(by='adjusted_show_name')
-                    cell_range = sheet.range("A1:E"+ str(len(client_df) + 1))
-                    df_as_list = ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"] + client_df.replace(np.NaN,"").values.flatten().tolist()
-                    count = 0
-                    for index,cell in enumerate(cell_range):
-                        cell.value = df_as_list[index]
-                    sheet.update_cells(cell_range)
+                    write_tab_diff(spreadsheet_id, "Database Names", dataframe_to_values(client_df, ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"]), go)
 
                     def title_strings(x):
                         if pd.notna(x):
@@ -2993,7 +3525,7 @@ def gsheet_budget_update_2020(active_client):
                     spot_placement_errors.fillna("Blank",inplace = True)
                     spot_placement_errors.rename(columns={'spot_placement':'error'},inplace=True)
                     spot_placement_errors['error'] = spot_placement_errors['error'].apply(lambda x: x + " is not an approved value for this column")
-                    df['num_spot'] = df['num_spot'].apply(lambda x: percentage_converter(x))
+                    df['num_spot'] = parse_percentage_column(df['num_spot'])
                     #df = df[df['num_spot'] > 0]
                     non_match_errors = df[df['master_vendor_id'].isna()][['roll_up_show','show_detail']].drop_duplicates()
                     non_match_errors['error_column'] = "Roll up - Show"
@@ -3107,25 +3639,10 @@ on act_cli.adjusted_client_id = budg.adjusted_client_id""",engine)
             col_data_type_dict[col] = VARCHAR
         schema = 'gsheet_budgets'
         table_name = 'gsheet_budgets_2020'
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
         for col in ['estimate','downloads_aqh',"cpm","commission",'gross_spot_cost','client_net_spot_cost','num_spot','master_vendor_id','adjusted_client_id']:
             print(col)
             col_data_type_dict[col] = FLOAT
-            df[col] = df[col].apply(lambda x: percentage_converter(x))
+            df[col] = parse_percentage_column(df[col])
         #df['date'] = df['date'].apply(lambda x: pd.to_datetime((x + "/2020").replace("12/31/2020","12/31/2019").replace("12/30/2020","12/30/2019")))
         df['estimate'] = df['estimate'].apply(lambda x: convert_to_int(x))
         df['estimate'] = pd.Series(data= df['estimate'],dtype="Int64")
@@ -3979,43 +4496,20 @@ def gsheet_budget_update_2021(active_client):
         names_df['formatted_smbs'] = names_df['vendor_name'].apply(lambda x: format_strings(x))
         #names_df['formatted_adjusted'] = names_df['adjusted_show_name'].apply(lambda x: format_strings(x))
         names_df['formatted_adjusted'] = names_df['adjusted_show_name'].str.lower()
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
         def gsheet_budget_upload(url,adjusted_client_ID):
             try:
                 print("getting info for: " + str(adjusted_client_ID))
-                json_datas = go
-                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-                client = gspread.authorize(creds)
-                workbook = client.open_by_url(url)
+                spreadsheet_id = spreadsheet_id_from_url(url)
+                tabs = get_workbook_tabs(spreadsheet_id, go)
 
-                try:
-                    workbook.add_worksheet("Database Names",rows = 4000,cols = 15)
-                except Exception as e:
-                    stuff = 1
+                if "Database Names" not in tabs:
+                    add_tab(spreadsheet_id, "Database Names", 4000, 15, go)
 #                try:
 #                    workbook.add_worksheet("Error Report",rows = 4000,cols = 15)
 #                except:
 #                    stuff = 1
 
-                sheet = workbook.worksheet("Flowchart")
-                list_of_values = sheet.get_all_values()
-
-                df = pd.DataFrame(data = list_of_values[1:],columns=list_of_values[0])
+                df = read_workbook_frames(spreadsheet_id, ["Flowchart"], go, tabs)["Flowchart"]
                 df = df[(df['Roll Up - Show'] != "") | (df['Roll Up - Show'].notna())]
                 if len(df) > 0:
                     try:
@@ -4060,16 +4554,9 @@ def gsheet_budget_update_2021(active_client):
                     df['date'] = df['date'].apply(lambda x: pd.to_datetime((x + "/2021").replace("12/28/2021","12/28/2020").replace("12/29/2021","12/29/2020").replace("12/30/2021","12/30/2020").replace("12/31/2021","12/31/2020")))
 
                     df.to_csv(str(adjusted_client_ID) + "_2021.csv",index = False)
-                    sheet = workbook.worksheet("Database Names")
-                    sheet.clear()
                     client_df = client_df[["estimate_id","estimate_name","vendor_name","adjusted_show_name","vendor_id"]]
                     client_df = client_df.sort_values(by='adjusted_show_name')
-                    cell_range = sheet.range("A1:E"+ str(len(client_df) + 1))
-                    df_as_list = ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"] + client_df.replace(np.NaN,"").values.flatten().tolist()
-                    count = 0
-                    for index,cell in enumerate(cell_range):
-                        cell.value = df_as_list[index]
-                    sheet.update_cells(cell_range)
+                    write_tab_diff(spreadsheet_id, "Database Names", dataframe_to_values(client_df, ["estimate id","estimate name","SBMS name","Database Name","Vendor ID"]), go)
 
                     def title_strings(x):
                         if pd.notna(x):
@@ -4095,7 +4582,7 @@ def gsheet_budget_update_2021(active_client):
                     spot_placement_errors.fillna("Blank",inplace = True)
                     spot_placement_errors.rename(columns={'spot_placement':'error'},inplace=True)
                     spot_placement_errors['error'] = spot_placement_errors['error'].apply(lambda x: x + " is not an approved value for this column")
-                    df['num_spot'] = df['num_spot'].apply(lambda x: percentage_converter(x))
+                    df['num_spot'] = parse_percentage_column(df['num_spot'])
                     #df = df[df['num_spot'] > 0]
                     non_match_errors = df[df['master_vendor_id'].isna()][['roll_up_show','show_detail']].drop_duplicates()
                     non_match_errors['error_column'] = "Roll up - Show"
@@ -4206,25 +4693,10 @@ def gsheet_budget_update_2021(active_client):
             col_data_type_dict[col] = VARCHAR
         schema = 'gsheet_budgets'
         table_name = 'gsheet_budgets_2021'
-        def percentage_converter(x):
-            if (type(x) == int) | (type(x) == float):
-                return x
-            else:
-                try:
-                    if pd.notna(x):
-                        if "%" in str(x):
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))/100
-                        else:
-                            final_number = float(re.sub("[^0-9.]",'',str(x)))
-                        return final_number
-                    else:
-                        return np.NaN
-                except:
-                    return np.NaN
         for col in ['estimate','downloads_aqh',"cpm","commission",'gross_spot_cost','client_net_spot_cost','num_spot','master_vendor_id','adjusted_client_id']:
             print(col)
             col_data_type_dict[col] = FLOAT
-            df[col] = df[col].apply(lambda x: percentage_converter(x))
+            df[col] = parse_percentage_column(df[col])
         #df['date'] = df['date'].apply(lambda x: pd.to_datetime((x + "/2021").replace("12/28/2021","12/28/2020").replace("12/29/2021","12/29/2020").replace("12/30/2021","12/30/2020").replace("12/31/2021","12/31/2020")))
         df['estimate'] = df['estimate'].apply(lambda x: convert_to_int(x))
         df['estimate'] = pd.Series(data= df['estimate'],dtype="Int64")
@@ -2,43 +2,45 @@
 # -*- coding: utf-8 -*-
 
 # Imports
+import abc
+import argparse
 import boto3
 import csv
 import datetime
+import hashlib
+import hmac
 import gspread
 import json
 import numpy as np
 import os
 import pandas as pd
 import pickle
+import queue
 import re
+import signal
+import sqlite3
 import string as strings
+import threading
 import time
+import urllib.error
+import urllib.request
+import uuid
 
-from arm_utilities import load_credentials, format_strings, convert_to_int
-from boto3.dynamodb.conditions import Key
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from arm_utilities import load_credentials, format_strings, convert_to_int, get_google_service, get_executor, dataframe_to_values, spreadsheet_id_from_url, write_tab_diff, quote_tab_name, execute_sheets_request, read_workbook_columns, serial_number_to_datetime, parse_currency_column
 from gspread_formatting import *
-from oauth2client.service_account import ServiceAccountCredentials
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from sqlalchemy.types import INTEGER,FLOAT,VARCHAR, BOOLEAN, DATETIME
 from threading import Thread
+from types import MappingProxyType
 
 
 # Global Variables
 acc,sh,em,post,ho,use,wo,database,go,look,look_sec = load_credentials()
 new_table = True
-local_radio_ids = []
-non_local_radio_ids = []
-range_string = ''
-range_string_2 = ''
-df_as_list_2 = ''
-df_as_list = ''
-error_list = []
 client_list_file_dir = os.path.dirname(os.path.realpath(__file__))
 client_list_file_name = 'client_list.json'
 debug = False
@@ -52,36 +54,271 @@ GSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
 GSHEET_NAME_ATTRIBUTE = 'name'
 GSHEET_ID_ATTRIBUTE = 'id'
 GSHEET_MODIFIED_TIME_ATTRIBUTE = 'modifiedTime'
-
-# AWS - Dynamo
+GSHEET_LAST_MODIFYING_USER_ATTRIBUTE = 'lastModifyingUser'
+GSHEET_FIELDS = 'id, name, modifiedTime'
+GSHEET_REVISION_FIELDS = 'nextPageToken, revisions(modifiedTime, lastModifyingUser(me, emailAddress))'
+DRIVE_REVISIONS_PAGE_SIZE = 1000
+TAB_FINGERPRINTS_ATTRIBUTE = 'tabFingerprints'
+
+# Promo Codes!B1, written by order_upload
+# Only these columns of the order workbook tabs are loaded, order tabs are mapped positionally onto the warehouse columns
+PROMO_COLUMNS = ['Show Name', 'Vendor ID', "Client", 'Promo Code', 'Budget Show Name', 'Unique Code', 'Code Leak Date']
+ORDER_COLUMN_COUNT = 23
+# Text columns keep their display strings with typed reads, codes like 01234 would otherwise come back as numbers
+PROMO_TEXT_COLUMNS = ['Show Name', "Client", 'Promo Code', 'Budget Show Name', 'Unique Code']
+ORDER_TEXT_POSITIONS = [1, 2, 14, 15, 16, 18]  # discount_code, client_name, tracking_type, product_type, lead_impression_type, session_type
+# Read the order workbook as UNFORMATTED_VALUE with SERIAL_NUMBER dates, so numbers arrive as numbers and dates
+# convert in one vectorized step instead of being parsed out of display strings
+ORDER_TYPED_READS = True
+ORDER_DATE_POSITIONS = [0, 19]  # date, code_leak_date
+
+# How order rows reach client_order_data.<table>_orders:
+#   full  - TRUNCATE and COPY the whole sheet
+#   delta - only the (date, discount_code) groups that changed since the last load's snapshot, applied from
+#           staging tables in one transaction
+#   window - only rows dated within the last ORDER_WINDOW_DAYS, with a full reload of every sheet that had window
+#            loads once per night after ORDER_FULL_RELOAD_HOUR (local time) to pick up older corrections
+#   open_year - only the current year's rows from "Current Year Orders"; closed years stay as loaded in the
+#            warehouse and "Historical Orders" is not read at all
+# window and open_year fall back to a full load for a sheet that has never had one.
+ORDER_LOAD_MODES = ['full', 'delta', 'window', 'open_year']
+ORDER_LOAD_MODE = 'full'
+ORDER_WINDOW_DAYS = 45
+ORDER_FULL_RELOAD_HOUR = 20
+ORDERS_LAST_FULL_LOAD_ATTRIBUTE = 'ordersLastFullLoad'
+ORDERS_WINDOW_PENDING_ATTRIBUTE = 'ordersWindowPending'
+ORDER_SNAPSHOT_BUCKET = 'adresults'
+ORDER_SNAPSHOT_SUFFIX = '_orders_snapshot.p'
+PROMO_VENDOR_ID_FORMULA = """=ARRAYFORMULA(IF(ROW(B1:B) = 1,"Vendor ID",iferror(IF(A1:A <> "",IFERROR(VLOOKUP(AF1:AF,'Link to Market Info'!A:M,13,False),IFERROR(VLOOKUP(A1:A,'Link to Market Info'!B:M,12,False), iferror(VLOOKUP(A1:A,'Link to Market Info'!F:M,8,FALSE),(VLOOKUP(A1:A,'Link to Market Info - Local Radio'!B:D,3,FALSE))))),""),AF1:AF)))"""
+
+# Google API - Drive changes feed
+GOOGLE_SHARED_DRIVE_ID = None  # Set when GOOGLE_DRIVE_FOLDER_ID lives on a shared drive
+DRIVE_BATCH_SIZE = 100  # Drive API limit of calls per batch HTTP request
+DRIVE_CHANGES_PAGE_SIZE = 1000
+DRIVE_CHANGES_RECORD_ID = '__drive_changes__'
+DRIVE_START_PAGE_TOKEN_ATTRIBUTE = 'startPageToken'
+DRIVE_LAST_FULL_SCAN_ATTRIBUTE = 'lastFullScan'
+DRIVE_RETRY_GSHEET_IDS_ATTRIBUTE = 'retryGSheetIDs'  # Sheets that failed to import, retried on the next incremental tick
+FULL_SCAN_INTERVAL_HOURS = 24
+
+# Maximum number of gSheets imported in parallel per run
+IMPORT_MAX_WORKERS = 4
+
+# Reference data written to every client's Market Info tabs
+REFERENCE_CACHE_TTL_SECONDS = 900
+REFERENCE_DATASETS = {
+    'local_radio': {
+        'query': """SELECT client_name,combined,date_added,pseudo_vendor_id FROM matt_testing.local_radio_pseudo_id""",
+        'version_query': """SELECT count(*), max(date_added) FROM matt_testing.local_radio_pseudo_id""",
+        'header': ["client_name","combined","date_added","pseudo_vendor_id"],
+    },
+    'unique_shows': {
+        'query': """select vendor_id, station_name, market_name, Media_Type, Adjusted_Market_Name, Adjusted_Show_Name, Genre_itunes, Genre_ARM, Subgenre_iTunes, Subgenre_ARM, Itunes_URL, Unique_show_flag, Master_vendor_id from production.gsheet.unique_shows""",
+        'version_query': """select count(*), max(_synced_at) from production.gsheet.unique_shows""",
+        'header': ["vendor_id","station_name","market_name","Media_Type","Adjusted_Market_Name","Adjusted_Show_Name","Genre_itunes","Genre_ARM","Subgenre_iTunes","Subgenre_ARM","Itunes_URL","Unique_show_flag","Master_vendor_id"],
+    },
+}
+_referenceCache = None
+_referenceCacheLock = threading.Lock()
+
+# client_list.json, indexed by order sheet ID and reloaded when the file changes
+_clientRegistry = None
+_clientRegistryLock = threading.Lock()
+
+# Daemon mode
+DAEMON_POLL_INTERVAL_SECONDS = 60
+_gSheetsInProgress = set()
+_gSheetsInProgressLock = threading.Lock()
+
+# Drive push notifications (webhook mode)
+WEBHOOK_ADDRESS = None  # Public HTTPS URL registered with Drive, forwarded to the local receiver below. Unset runs
+                        # the receiver in local test mode: channels are only registered locally, for --notify
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_DEBOUNCE_SECONDS = 5
+WEBHOOK_POLL_INTERVAL_SECONDS = 900  # Safety-net scan while notifications drive the imports
+WATCH_CHANNEL_TTL_SECONDS = 86400  # Drive caps file watch channels at one day
+WATCH_CHANNEL_RENEW_SECONDS = 3600  # Renew channels expiring within this window
+_watchChannels = {}
+_watchChannelsLock = threading.Lock()
+_notificationQueue = queue.Queue()
+
+# Redshift
+ENGINE_POOL_RECYCLE_SECONDS = 3600
+_engine = None
+_engine_lock = threading.Lock()
+
+# Checkpoint store - 'dynamodb' or 'sqlite'
+CHECKPOINT_BACKEND = 'dynamodb'
 DYNAMODB_TABLE = 'gSheetsModified'
-DYNAMODB = boto3.resource('dynamodb')
-
-def dynamo_add_gsheet_record(gSheet):
-    table = DYNAMODB.Table(DYNAMODB_TABLE)
-    response = table.put_item(
-        Item=gSheet
-    )
-    return response
-
-def dynamo_find_gsheet_record(gSheetID):
-    table = DYNAMODB.Table(DYNAMODB_TABLE)
-    response = table.query(
-        KeyConditionExpression=Key('id').eq(gSheetID)
-    )
-    try:
-        return response['Items'][0]
-    except IndexError:
-        # No match found, return None
-        return None
+DYNAMODB_BATCH_GET_SIZE = 100  # batch_get_item limit of keys per request
+SQLITE_CHECKPOINT_PATH = os.path.join(dir_path, 'gSheetsModified.sqlite')
+SQLITE_BATCH_GET_SIZE = 500  # Stays under SQLite's limit of variables per statement
+_checkpointStore = None
+_checkpointStoreLock = threading.Lock()
+
+def get_engine():
+    # One SQLAlchemy engine (and connection pool) per process, reused by every import
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(post, pool_pre_ping=True, pool_recycle=ENGINE_POOL_RECYCLE_SECONDS)
+        return _engine
+
+class ImportContext(object):
+    # State for a single importSheet run, passed to order_upload and the Market Info tab updates instead of
+    # module globals so several imports can run at the same time
+    def __init__(self, gSheet, checkpoint=None, new_table=new_table):
+        self.gSheet = gSheet
+        self.new_table = new_table
+        # Fingerprints of the consumed tabs as of the last successful load of each, updated as stages finish
+        self.previous_tab_fingerprints = dict((checkpoint or {}).get(TAB_FINGERPRINTS_ATTRIBUTE) or {})
+        self.tab_fingerprints = dict(self.previous_tab_fingerprints)
+        # Orders reloaded in full (or by delta) as of, and whether window loads have happened since
+        self.orders_last_full_load = (checkpoint or {}).get(ORDERS_LAST_FULL_LOAD_ATTRIBUTE)
+        self.orders_window_pending = bool((checkpoint or {}).get(ORDERS_WINDOW_PENDING_ATTRIBUTE))
+        self.orders_reconcile_due = ordersReconcileDue(checkpoint)
+        self.local_radio_ids = []
+        self.non_local_radio_ids = []
+        self.local_radio_values = []
+        self.unique_shows_values = []
+        self.error_list = []
+
+    def tabs_unchanged(self, fingerprints):
+        return all(self.previous_tab_fingerprints.get(tab) == fingerprint for tab, fingerprint in fingerprints.items())
+
+    def orders_load_mode(self):
+        # Window and open year loads only make sense on top of a full load
+        if ORDER_LOAD_MODE == 'window' and self.orders_reconcile_due:
+            return 'full'
+        if ORDER_LOAD_MODE in ('window', 'open_year') and not self.orders_last_full_load:
+            return 'full'
+        # A year closes with whatever its rows looked like at the last full load. After New Year the closing year's
+        # December rows may still sit in "Current Year Orders", so load everything once before going open year only.
+        if ORDER_LOAD_MODE == 'open_year' and datetime.datetime.fromisoformat(self.orders_last_full_load) < open_year_start_utc():
+            return 'full'
+        return ORDER_LOAD_MODE
+
+    def orders_loaded(self, mode):
+        if mode in ('window', 'open_year'):
+            self.orders_window_pending = True
+        else:
+            self.orders_window_pending = False
+            self.orders_last_full_load = datetime.datetime.utcnow().isoformat()
+
+    def checkpoint_attributes(self):
+        return {
+            TAB_FINGERPRINTS_ATTRIBUTE: self.tab_fingerprints,
+            ORDERS_LAST_FULL_LOAD_ATTRIBUTE: self.orders_last_full_load,
+            ORDERS_WINDOW_PENDING_ATTRIBUTE: self.orders_window_pending,
+        }
+
+def tab_fingerprint(values):
+    # Cheap content hash of a tab as returned by get_all_values
+    return hashlib.sha1(json.dumps(values, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def read_order_workbook(spreadsheet_id, tab_columns):
+    if ORDER_TYPED_READS:
+        formatted_columns = dict((tab, PROMO_TEXT_COLUMNS if tab == "Promo Codes" else ORDER_TEXT_POSITIONS) for tab in tab_columns)
+        return read_workbook_columns(spreadsheet_id, tab_columns, go, value_render_option='UNFORMATTED_VALUE', date_time_render_option='SERIAL_NUMBER',
+                                     formatted_columns=formatted_columns)
+    return read_workbook_columns(spreadsheet_id, tab_columns, go)
+
+def convert_order_dates(orders_df):
+    # Typed reads leave dates as serial numbers, convert them by position as the header names vary between tabs
+    if ORDER_TYPED_READS:
+        for position in ORDER_DATE_POSITIONS:
+            column = orders_df.columns[position]
+            orders_df[column] = serial_number_to_datetime(orders_df[column])
+    return orders_df
+
+def frame_fingerprint(df):
+    # tab_fingerprint of the columns actually read from a tab, header row first
+    return tab_fingerprint([list(df.columns)] + df.values.tolist())
+
+class CheckpointStore(abc.ABC):
+    # Last seen Drive metadata per gSheet ID, plus the Drive changes feed record, as plain dicts keyed by 'id'
+    def get(self, gSheetID):
+        return self.get_many([gSheetID]).get(gSheetID)
+
+    @abc.abstractmethod
+    def get_many(self, gSheetIDs):
+        pass
+
+    @abc.abstractmethod
+    def put(self, record):
+        pass
+
+class DynamoCheckpointStore(CheckpointStore):
+    def __init__(self, table_name=DYNAMODB_TABLE):
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table_name = table_name
+        self.table = self.dynamodb.Table(table_name)
+
+    def put(self, record):
+        self.table.put_item(Item=record)
+
+    def get_many(self, gSheetIDs):
+        # DYNAMODB_BATCH_GET_SIZE keys per batch_get_item call
+        records = {}
+        for start in range(0, len(gSheetIDs), DYNAMODB_BATCH_GET_SIZE):
+            keys = [{GSHEET_ID_ATTRIBUTE: gSheetID} for gSheetID in gSheetIDs[start:start + DYNAMODB_BATCH_GET_SIZE]]
+            requestItems = {self.table_name: {'Keys': keys}}
+            retries = 0
+            while requestItems:
+                response = self.dynamodb.batch_get_item(RequestItems=requestItems)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    records[item.get(GSHEET_ID_ATTRIBUTE)] = item
+                # Throttled keys come back unprocessed and have to be asked for again
+                requestItems = response.get('UnprocessedKeys')
+                if requestItems:
+                    retries += 1
+                    time.sleep(min(2 ** retries * 0.1, 5))
+        return records
+
+class SQLiteCheckpointStore(CheckpointStore):
+    # Local single-node store, records are kept as JSON next to their ID
+    def __init__(self, path=SQLITE_CHECKPOINT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS gsheets_modified (id TEXT PRIMARY KEY, record TEXT NOT NULL)""")
+
+    def get_many(self, gSheetIDs):
+        records = {}
+        with self.lock:
+            for start in range(0, len(gSheetIDs), SQLITE_BATCH_GET_SIZE):
+                chunk = gSheetIDs[start:start + SQLITE_BATCH_GET_SIZE]
+                rows = self.connection.execute(
+                    """SELECT id, record FROM gsheets_modified WHERE id IN ({})""".format(",".join("?" * len(chunk))), chunk)
+                for gSheetID, record in rows:
+                    records[gSheetID] = json.loads(record)
+        return records
+
+    def put(self, record):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT OR REPLACE INTO gsheets_modified (id, record) VALUES (?, ?)""",
+                (record.get(GSHEET_ID_ATTRIBUTE), json.dumps(record, default=str)))
+
+def get_checkpoint_store():
+    global _checkpointStore
+    with _checkpointStoreLock:
+        if _checkpointStore is None:
+            if CHECKPOINT_BACKEND == 'sqlite':
+                _checkpointStore = SQLiteCheckpointStore()
+            elif CHECKPOINT_BACKEND == 'dynamodb':
+                _checkpointStore = DynamoCheckpointStore()
+            else:
+                raise ValueError("Unknown CHECKPOINT_BACKEND {}".format(CHECKPOINT_BACKEND))
+        return _checkpointStore
 
 def getSheet(fileID):
-    creds = service_account.Credentials.from_service_account_info(
-        GOOGLE_SERVICE_ACCOUNT_INFO, scopes=SCOPES)
-    service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
     gSheet = service.files().get(
         fileId = fileID,
-        fields='id, name, modifiedTime',
+        fields=GSHEET_FIELDS,
         ).execute()
     gSheetID = gSheet.get('id')
     gSheetName = gSheet.get('name')
@@ -89,11 +326,181 @@ def getSheet(fileID):
     print ("{} INFO: getSheet - Found Google Drive file: {} ({})".format(datetime.datetime.now(), gSheetName, gSheetModifiedTime))
     return (gSheet)
 
-def scanGDrive():
-    creds = service_account.Credentials.from_service_account_info(
-        GOOGLE_SERVICE_ACCOUNT_INFO, scopes=SCOPES)
-    service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+def getSheets(fileIDs):
+    # Same metadata as getSheet, fetched DRIVE_BATCH_SIZE files at a time in a single Drive batch HTTP request
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+    gSheets = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            print ("{} ERROR: getSheets - Unable to fetch Google Drive file {}: {}".format(datetime.datetime.now(), request_id, exception))
+        else:
+            gSheets[response.get(GSHEET_ID_ATTRIBUTE)] = response
+
+    for start in range(0, len(fileIDs), DRIVE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for fileID in fileIDs[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(service.files().get(
+                fileId = fileID,
+                supportsAllDrives = True,
+                fields=GSHEET_FIELDS,
+                ), request_id=fileID)
+        batch.execute()
+
+    print ("{} INFO: getSheets - Found {} of {} Google Drive file(s)".format(datetime.datetime.now(), len(gSheets), len(fileIDs)))
+    return gSheets
+
+def getStartPageToken(service):
+    response = service.changes().getStartPageToken(
+        supportsAllDrives = True,
+        driveId = GOOGLE_SHARED_DRIVE_ID,
+        ).execute()
+    return response.get('startPageToken')
+
+def find_changes_record():
+    return get_checkpoint_store().get(DRIVE_CHANGES_RECORD_ID)
+
+def add_changes_record(startPageToken, lastFullScan, retryGSheetIDs=None):
+    changesRecord = {
+        GSHEET_ID_ATTRIBUTE: DRIVE_CHANGES_RECORD_ID,
+        DRIVE_START_PAGE_TOKEN_ATTRIBUTE: startPageToken,
+        DRIVE_LAST_FULL_SCAN_ATTRIBUTE: lastFullScan,
+        DRIVE_RETRY_GSHEET_IDS_ATTRIBUTE: list(retryGSheetIDs or []),
+    }
+    get_checkpoint_store().put(changesRecord)
+
+def last_order_reload_boundary():
+    # Most recent ORDER_FULL_RELOAD_HOUR in local time, as naive UTC like the other stored timestamps
+    now = datetime.datetime.now()
+    boundary = now.replace(hour=ORDER_FULL_RELOAD_HOUR, minute=0, second=0, microsecond=0)
+    if boundary > now:
+        boundary -= datetime.timedelta(days=1)
+    return boundary.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+def ordersReconcileDue(checkpoint):
+    # A sheet loaded by window since its last full load gets one full reload after each nightly boundary
+    if ORDER_LOAD_MODE != 'window' or not (checkpoint or {}).get(ORDERS_WINDOW_PENDING_ATTRIBUTE):
+        return False
+    lastFullLoad = checkpoint.get(ORDERS_LAST_FULL_LOAD_ATTRIBUTE)
+    return not lastFullLoad or datetime.datetime.fromisoformat(lastFullLoad) < last_order_reload_boundary()
+
+def modifiedBySelf(revision):
+    lastModifyingUser = revision.get(GSHEET_LAST_MODIFYING_USER_ATTRIBUTE) or {}
+    return lastModifyingUser.get('me') == True
+
+def modifiedOnlyBySelf(gSheetID, since):
+    # True when the gSheet has Drive revisions saved after the since timestamp and the importer made every one of
+    # them (B1, Market Info tabs, or the recalculation they trigger, however late it lands). Revisions are listed
+    # oldest first with no filter, so the whole list is paged through.
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+    revisions = []
+    page_token = None
+    while True:
+        response = service.revisions().list(
+            fileId = gSheetID,
+            pageSize = DRIVE_REVISIONS_PAGE_SIZE,
+            fields = GSHEET_REVISION_FIELDS,
+            pageToken = page_token,
+            ).execute()
+        revisions += [revision for revision in response.get('revisions', []) if revision.get(GSHEET_MODIFIED_TIME_ATTRIBUTE, '') > since]
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+    return len(revisions) > 0 and all(modifiedBySelf(revision) for revision in revisions)
+
+def checkpointAfterImport(gSheet, updatedGSheet):
+    # The modified time read back after an import can only be recorded if every revision since the scanned one was
+    # ours. If someone else edited the sheet while the import ran keep the pre-import timestamp so the next scan
+    # imports their edit instead of skipping it.
+    if updatedGSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE) == gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE) or modifiedOnlyBySelf(gSheet.get(GSHEET_ID_ATTRIBUTE), gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE)):
+        return updatedGSheet
+    print ("{} INFO: checkpointAfterImport - gSheet {} (ID: {}) was modified by someone else during the import, keeping timestamp ({})".format(datetime.datetime.now(), gSheet.get(GSHEET_NAME_ATTRIBUTE), gSheet.get(GSHEET_ID_ATTRIBUTE), gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE)))
+    return dict(gSheet)
+
+def processGSheet(gSheet, checkpoint):
+    # checkpoint is the gSheet's record as loaded by processGSheets, None on the first run
+    gSheetID = gSheet.get(GSHEET_ID_ATTRIBUTE)
+    gSheetName = gSheet.get(GSHEET_NAME_ATTRIBUTE)
+    gSheetModifiedTime = gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE)
+
+    if checkpoint is None:
+        # No matching record suggests first run for gSheet
+        print ("{} INFO: processGSheet - Running import for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
+        ctx = importSheet(gSheet)
+        print ("{} INFO: processGSheet - Updating checkpoint with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))
+        updatedGSheet = checkpointAfterImport(gSheet, getSheet(gSheetID))
+        updatedGSheet.update(ctx.checkpoint_attributes())
+        get_checkpoint_store().put(updatedGSheet)
+
+    else:
+        previousTimeStamp = checkpoint.get(GSHEET_MODIFIED_TIME_ATTRIBUTE, '')
+        reconcileDue = ordersReconcileDue(checkpoint)
+        if previousTimeStamp == gSheetModifiedTime and not reconcileDue:
+            print ("{} INFO: processGSheet - Previous timestamp matches current timestamp, Skipping import for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
+        elif not reconcileDue and modifiedOnlyBySelf(gSheetID, previousTimeStamp):
+            # Every revision since the last checkpoint is one of our own writes or the recalculation they triggered
+            print ("{} INFO: processGSheet - gSheet {} (ID: {}) was only modified by the importer, recording timestamp ({}) without importing".format(datetime.datetime.now(), gSheetName, gSheetID, gSheetModifiedTime))
+            gSheet[TAB_FINGERPRINTS_ATTRIBUTE] = checkpoint.get(TAB_FINGERPRINTS_ATTRIBUTE) or {}
+            gSheet[ORDERS_LAST_FULL_LOAD_ATTRIBUTE] = checkpoint.get(ORDERS_LAST_FULL_LOAD_ATTRIBUTE)
+            gSheet[ORDERS_WINDOW_PENDING_ATTRIBUTE] = checkpoint.get(ORDERS_WINDOW_PENDING_ATTRIBUTE)
+            get_checkpoint_store().put(gSheet)
+        else:
+            if reconcileDue:
+                print ("{} INFO: processGSheet - Nightly full order reload due, Running import for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
+            else:
+                print ("{} INFO: processGSheet - Previous timestamp ({}) differs from current timestamp ({}), Running import for gSheet {} (ID: {})".format(datetime.datetime.now(), previousTimeStamp, gSheetModifiedTime, gSheetName, gSheetID))
+            ctx = importSheet(gSheet, checkpoint)
+            print ("{} INFO: processGSheet - Updating checkpoint with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))
+            updatedGSheet = checkpointAfterImport(gSheet, getSheet(gSheetID))
+            updatedGSheet.update(ctx.checkpoint_attributes())
+            get_checkpoint_store().put(updatedGSheet)
+            print ("{} INFO: processGSheet - Successfully updated checkpoint with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))
+        print ("")
+
+def processGSheets(gSheets, max_workers=IMPORT_MAX_WORKERS):
+    # Import up to max_workers gSheets at once, each sheet writes its own checkpoint as soon as it finishes and
+    # a failure in one sheet is logged without holding up the others. Returns the IDs of the failed sheets.
+    failedGSheetIDs = []
+
+    print ("{} INFO: processGSheets - Querying checkpoint store to find previous last modified times".format(datetime.datetime.now()))
+    checkpoints = get_checkpoint_store().get_many([gSheet.get(GSHEET_ID_ATTRIBUTE) for gSheet in gSheets])
+    # First-run sheets get their checkpoint from processGSheet once their import succeeds, writing it any earlier
+    # would skip them for good if the import fails or the process dies
+    newGSheets = [gSheet for gSheet in gSheets if gSheet.get(GSHEET_ID_ATTRIBUTE) not in checkpoints]
+    if newGSheets:
+        print ("{} INFO: processGSheets - No previous timestamp found for {} gSheet(s)".format(datetime.datetime.now(), len(newGSheets)))
+
+    def run(gSheet):
+        gSheetID = gSheet.get(GSHEET_ID_ATTRIBUTE)
+        # Scans and webhook notifications can ask for the same sheet at once, only one of them imports it
+        with _gSheetsInProgressLock:
+            if gSheetID in _gSheetsInProgress:
+                print ("{} INFO: processGSheets - gSheet {} (ID: {}) is already being imported, skipping".format(datetime.datetime.now(), gSheet.get(GSHEET_NAME_ATTRIBUTE), gSheetID))
+                return
+            _gSheetsInProgress.add(gSheetID)
+        try:
+            processGSheet(gSheet, checkpoints.get(gSheetID))
+        except Exception as e:
+            print ("{} ERROR: processGSheets - Import failed for gSheet {} (ID: {}): {}".format(datetime.datetime.now(), gSheet.get(GSHEET_NAME_ATTRIBUTE), gSheetID, e))
+            failedGSheetIDs.append(gSheetID)
+        finally:
+            with _gSheetsInProgressLock:
+                _gSheetsInProgress.discard(gSheetID)
+
+    print ("{} INFO: processGSheets - Processing {} gSheet(s) with up to {} worker(s)".format(datetime.datetime.now(), len(gSheets), max_workers))
+    list(get_executor('gsheet-import', max(1, max_workers)).map(run, gSheets))
+    return failedGSheetIDs
+
+def scanGDrive(max_workers=IMPORT_MAX_WORKERS):
+    # Full listing of the folder, also used as the periodic reconciliation pass for scanGDriveChanges
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
     page_token = None
+    gSheetList = []
+    failedGSheetIDs = []
+
+    # Take the change feed token before listing so edits made during the scan are picked up next tick
+    startPageToken = getStartPageToken(service)
+    scanStartTime = datetime.datetime.utcnow().isoformat()
 
     while True:
         # Search for gSheets on Drive API
@@ -101,86 +508,360 @@ def scanGDrive():
             q = "'" + GOOGLE_DRIVE_FOLDER_ID + "' in parents and mimeType = '" + GSHEET_MIME_TYPE + "'",
             includeItemsFromAllDrives = True,
             supportsAllDrives = True,
+            pageSize = DRIVE_BATCH_SIZE,
             fields='nextPageToken, files(id)',
             pageToken=page_token).execute()
 
-        for file in response.get('files', []):
-            # Pull latest info based on ID as query metadata is cached and may be stale
-            gSheet = getSheet(file.get(GSHEET_ID_ATTRIBUTE))
-
-            gSheetID = gSheet.get(GSHEET_ID_ATTRIBUTE)
-            gSheetName = gSheet.get(GSHEET_NAME_ATTRIBUTE)
-            gSheetModifiedTime = gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE)
-            print ("{} INFO: scanGDrive - Querying Dynamo DB to find previous last modified time".format(datetime.datetime.now()))
-            dynamodbResponse = dynamo_find_gsheet_record(gSheetID)
-
-            if dynamodbResponse is None:
-                # No matching record suggests first run for gSheet
-                print ("{} INFO: scanGDrive - No previous timestamp found. Adding timestamp to DB for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
-                putGSheetResponse = dynamo_add_gsheet_record(gSheet)
-
-                print ("{} INFO: scanGDrive - Running import for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
-                importSheet(gSheet)
-                print ("{} INFO: scanGDrive - Updating DB with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))
-                updatedGSheet = getSheet(gSheetID)
-                putGSheetResponse = dynamo_add_gsheet_record(updatedGSheet)
-
-            else:
-                previousTimeStamp = dynamodbResponse.get(GSHEET_MODIFIED_TIME_ATTRIBUTE, '')
-                if previousTimeStamp == gSheetModifiedTime:
-                    print ("{} INFO: scanGDrive - Previous timestamp matches current timestamp, Skipping import for gSheet {} (ID: {})".format(datetime.datetime.now(), gSheetName, gSheetID))
-                else:
-                    print ("{} INFO: scanGDrive - Previous timestamp ({}) differs from current timestamp ({}), Running import for gSheet {} (ID: {})".format(datetime.datetime.now(), previousTimeStamp, gSheetModifiedTime, gSheetName, gSheetID))
-                    importSheet(gSheet)
-                    print ("{} INFO: scanGDrive - Updating DB with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))
-                    updatedGSheet = getSheet(gSheetID)
-                    putGSheetResponse = dynamo_add_gsheet_record(updatedGSheet)
-                    print ("{} INFO: scanGDrive - Successfully updated DB with new {} property {} (ID: {})".format(datetime.datetime.now(), GSHEET_MODIFIED_TIME_ATTRIBUTE, gSheetName, gSheetID))                    
-                print ("")
+        # Pull latest info based on ID as query metadata is cached and may be stale
+        fileIDs = [file.get(GSHEET_ID_ATTRIBUTE) for file in response.get('files', [])]
+        gSheets = getSheets(fileIDs)
+        gSheetList += [gSheets[fileID] for fileID in fileIDs if fileID in gSheets]
+        failedGSheetIDs += [fileID for fileID in fileIDs if fileID not in gSheets]
 
         page_token = response.get('nextPageToken', None)
         if page_token is None:
             break
 
-def update_local_radio_tab(url):
+    failedGSheetIDs += processGSheets(gSheetList, max_workers)
+
+    # Failed sheets are not in the changes feed after this token, keep them for the next tick to retry
+    print ("{} INFO: scanGDrive - Saving Drive changes start page token {}, {} gSheet(s) to retry".format(datetime.datetime.now(), startPageToken, len(failedGSheetIDs)))
+    add_changes_record(startPageToken, scanStartTime, failedGSheetIDs)
+
+def listChangedGSheetIDs(service, startPageToken):
+    # Walk the Drive changes feed from startPageToken, returning the changed gSheet IDs in the import folder
+    # along with the token to resume from on the next tick
+    gSheetIDs = []
+    page_token = startPageToken
+
+    while True:
+        response = service.changes().list(
+            pageToken = page_token,
+            spaces = 'drive',
+            driveId = GOOGLE_SHARED_DRIVE_ID,
+            includeItemsFromAllDrives = True,
+            supportsAllDrives = True,
+            pageSize = DRIVE_CHANGES_PAGE_SIZE,
+            fields = 'nextPageToken, newStartPageToken, changes(fileId, removed, file(mimeType, parents, trashed))',
+            ).execute()
+
+        for change in response.get('changes', []):
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed'):
+                continue
+            if file.get('mimeType') != GSHEET_MIME_TYPE:
+                continue
+            if GOOGLE_DRIVE_FOLDER_ID not in file.get('parents', []):
+                continue
+            if change.get('fileId') not in gSheetIDs:
+                gSheetIDs.append(change.get('fileId'))
+
+        if 'newStartPageToken' in response:
+            return gSheetIDs, response.get('newStartPageToken')
+        page_token = response.get('nextPageToken')
+
+def scanGDriveChanges(max_workers=IMPORT_MAX_WORKERS):
+    changesRecord = find_changes_record()
+    startPageToken = changesRecord.get(DRIVE_START_PAGE_TOKEN_ATTRIBUTE)
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+
+    retryGSheetIDs = list(changesRecord.get(DRIVE_RETRY_GSHEET_IDS_ATTRIBUTE) or [])
+
+    gSheetIDs, newStartPageToken = listChangedGSheetIDs(service, startPageToken)
+    print ("{} INFO: scanGDriveChanges - Found {} changed gSheet(s) since token {}, retrying {} failed gSheet(s)".format(datetime.datetime.now(), len(gSheetIDs), startPageToken, len(retryGSheetIDs)))
+    gSheetIDs = list(dict.fromkeys(gSheetIDs + retryGSheetIDs))
+
+    gSheets = getSheets(gSheetIDs)
+    failedGSheetIDs = [gSheetID for gSheetID in gSheetIDs if gSheetID not in gSheets]
+    failedGSheetIDs += processGSheets([gSheets[gSheetID] for gSheetID in gSheetIDs if gSheetID in gSheets], max_workers)
+
+    # The token always advances, sheets that failed this tick are kept in the record and retried on the next one
+    if failedGSheetIDs:
+        print ("{} ERROR: scanGDriveChanges - {} gSheet(s) failed, retrying them on the next tick".format(datetime.datetime.now(), len(failedGSheetIDs)))
+    if newStartPageToken != startPageToken or failedGSheetIDs != retryGSheetIDs:
+        add_changes_record(newStartPageToken, changesRecord.get(DRIVE_LAST_FULL_SCAN_ATTRIBUTE), failedGSheetIDs)
+
+def fullScanDue(changesRecord):
+    if changesRecord is None or not changesRecord.get(DRIVE_START_PAGE_TOKEN_ATTRIBUTE):
+        return True
+    lastFullScan = changesRecord.get(DRIVE_LAST_FULL_SCAN_ATTRIBUTE)
+    if not lastFullScan:
+        return True
+    # Window loads need every sheet looked at once after the nightly boundary, unchanged ones included
+    if ORDER_LOAD_MODE == 'window' and datetime.datetime.fromisoformat(lastFullScan) < last_order_reload_boundary():
+        return True
+    elapsed = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(lastFullScan)
+    return elapsed >= datetime.timedelta(hours=FULL_SCAN_INTERVAL_HOURS)
+
+def runScan(full_scan=False, max_workers=IMPORT_MAX_WORKERS):
+    # Incremental scan from the Drive changes feed, falling back to a full folder listing when no token
+    # is stored yet, when one is requested, or when the reconciliation interval has passed
+    if full_scan or fullScanDue(find_changes_record()):
+        print ("{} INFO: runScan - Running full scan of Google Drive folder {}".format(datetime.datetime.now(), GOOGLE_DRIVE_FOLDER_ID))
+        scanGDrive(max_workers)
+    else:
+        print ("{} INFO: runScan - Running incremental scan from Drive changes feed".format(datetime.datetime.now()))
+        scanGDriveChanges(max_workers)
+
+def ensure_vendor_id_formula(spreadsheet_id):
+    # Rewriting B1 forces the whole sheet to recalculate and bumps its modified time, only write it when missing
+    service = get_google_service('sheets', 'v4', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+    cell = quote_tab_name("Promo Codes") + "!B1"
+    values = execute_sheets_request(lambda: service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id, range=cell, valueRenderOption='FORMULA')).get('values', [])
+    currentFormula = values[0][0] if values and values[0] else ''
+    if re.sub(r'\s+', '', str(currentFormula)).upper() == re.sub(r'\s+', '', PROMO_VENDOR_ID_FORMULA).upper():
+        if debug: print ('{} DEBUG: ensure_vendor_id_formula - Vendor ID formula already present'.format(datetime.datetime.now()))
+        return False
+    execute_sheets_request(lambda: service.spreadsheets().values().update(
+        spreadsheetId=spreadsheet_id, range=cell, valueInputOption='USER_ENTERED', body={'values': [[PROMO_VENDOR_ID_FORMULA]]}), quota='write')
+    return True
+
+class ReferenceDataCache(object):
+    # Loads each of REFERENCE_DATASETS once and shares the frame and its cell values with every import. After
+    # ttl seconds the next get runs the dataset's cheap version query and only reloads when the version moved.
+    def __init__(self, ttl=REFERENCE_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def version(self, name):
+        return tuple(str(x) for x in pd.read_sql(REFERENCE_DATASETS[name]['version_query'], get_engine()).iloc[0])
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and time.time() - entry['checked'] < self.ttl:
+                return entry
+
+            version = self.version(name)
+            if entry is not None and entry['version'] == version:
+                entry['checked'] = time.time()
+                return entry
+
+            print ('{} INFO: ReferenceDataCache - Loading {} (version {})'.format(datetime.datetime.now(), name, version))
+            dataset = REFERENCE_DATASETS[name]
+            frame = pd.read_sql(dataset['query'], get_engine())
+            values = dataframe_to_values(frame, dataset['header'])
+            entry = {'frame': frame, 'values': values, 'version': version, 'checked': time.time()}
+            self.entries[name] = entry
+            return entry
+
+def get_reference_cache():
+    global _referenceCache
+    with _referenceCacheLock:
+        if _referenceCache is None:
+            _referenceCache = ReferenceDataCache()
+        return _referenceCache
+
+class ClientRegistry(object):
+    # Parses client_list.json once and indexes the clients by the spreadsheet ID in their order_url. Every lookup
+    # stats the file and reloads it when its mtime moved; readers get an immutable snapshot, so concurrent imports
+    # never see a half-built index. A file that fails to parse keeps the previous snapshot in place.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.clients = MappingProxyType({})
+
+    def load(self):
+        with open(self.path) as client_list_file:
+            client_list = json.load(client_list_file)
+        clients = {}
+        for client in client_list:
+            gSheetID = spreadsheet_id_from_url(client.get('order_url'))
+            if gSheetID is None:
+                print ('{} WARNING: ClientRegistry - No spreadsheet ID in order_url for {}'.format(datetime.datetime.now(), client.get('adj_cli')))
+            elif gSheetID in clients:
+                print ('{} WARNING: ClientRegistry - Duplicate order_url for {}, keeping {}'.format(datetime.datetime.now(), client.get('adj_cli'), clients[gSheetID].get('adj_cli')))
+            else:
+                clients[gSheetID] = MappingProxyType(dict(client))
+        return MappingProxyType(clients)
+
+    def snapshot(self):
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime:
+                print ('{} INFO: ClientRegistry - Loading client list from {}...'.format(datetime.datetime.now(), self.path))
+                try:
+                    self.clients = self.load()
+                except ValueError as e:
+                    if self.mtime is None:
+                        raise
+                    print ('{} ERROR: ClientRegistry - Keeping previous client list, {} failed to parse: {}'.format(datetime.datetime.now(), self.path, e))
+                self.mtime = mtime
+            return self.clients
+
+    def find(self, gSheetID):
+        return self.snapshot().get(gSheetID)
+
+def get_client_registry():
+    global _clientRegistry
+    with _clientRegistryLock:
+        if _clientRegistry is None:
+            _clientRegistry = ClientRegistry(client_list_file_dir + "/" + client_list_file_name)
+        return _clientRegistry
+
+def update_local_radio_tab(url, ctx):
     print ('{} INFO: update_local_radio_tab - Starting...'.format(datetime.datetime.now()))
     try:
-        json_datas = go
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-        client = gspread.authorize(creds)
-        sheet = client.open_by_url(url).worksheet("Link to Market Info - Local Radio")
-        cell_range = sheet.range(range_string)
-        count = 0
-        for cell in cell_range:
-            cell.value = df_as_list[count]
-            count += 1
-        sheet.clear()
-        sheet.update_cells(cell_range)
+        write_tab_diff(spreadsheet_id_from_url(url), "Link to Market Info - Local Radio", ctx.local_radio_values, go)
         print ('{} INFO: update_local_radio_tab - Done'.format(datetime.datetime.now()))   
     except Exception as e:
         print ('{} ERROR: update_local_radio_tab - {}'.format(datetime.datetime.now(), e))   
 
-def update_non_local_radio_tab(url):
+def update_non_local_radio_tab(url, ctx):
     print ('{} INFO: update_non_local_radio_tab - Starting...'.format(datetime.datetime.now()))
     try:
-        json_datas = go
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-        client = gspread.authorize(creds)
-        sheet = client.open_by_url(url).worksheet("Link to Market Info")
-        cell_range_2 = sheet.range(range_string_2)
-        count = 0
-        for cell in cell_range_2:
-            cell.value = df_as_list_2[count]
-            count += 1
-        sheet.clear()
-        sheet.update_cells(cell_range_2)
+        write_tab_diff(spreadsheet_id_from_url(url), "Link to Market Info", ctx.unique_shows_values, go)
         print ('{} INFO: update_non_local_radio_tab - Done'.format(datetime.datetime.now()))   
     except Exception as e:
         print ('{} ERROR: update_non_local_radio_tab - {}'.format(datetime.datetime.now(), e))   
 
-def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomendation):
+def copy_from_s3(target, file_name):
+    return """copy """ + target + """
+    from 's3://adresults/""" + file_name + """'
+    credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
+    IGNOREHEADER 1
+    EMPTYASNULL
+    csv;"""
+
+def upload_csv_to_s3(df, file_name):
+    df.to_csv(file_name,index=False)
+    session = boto3.Session()
+    s3 = session.resource("s3")
+    s3.meta.client.upload_file(file_name,'adresults',file_name)
+    os.remove(file_name)
+
+def order_keys(orders_df):
+    # Natural key of an order row, the same string the warehouse side builds in load_orders_delta
+    return orders_df['date'].dt.strftime('%Y-%m-%d').fillna('') + '|' + orders_df['discount_code'].astype(str).where(orders_df['discount_code'].notna(), '')
+
+def order_snapshot(orders_df):
+    # Per natural key: row count and two 32 bit halves of the summed row hashes, so the signature of a group does not
+    # depend on row order but changes with any edit, insert or delete inside it
+    row_hashes = pd.util.hash_pandas_object(orders_df, index=False).values
+    groups = pd.DataFrame({
+        'key': order_keys(orders_df).values,
+        'lo': (row_hashes & 0xFFFFFFFF).astype(np.int64),
+        'hi': (row_hashes >> 32).astype(np.int64),
+    })
+    return groups.groupby('key').agg(rows=('lo', 'size'), lo=('lo', 'sum'), hi=('hi', 'sum'))
+
+def order_snapshot_name(table_name):
+    return table_name + ORDER_SNAPSHOT_SUFFIX
+
+def load_order_snapshot(table_name):
+    s3 = boto3.client('s3')
+    try:
+        body = s3.get_object(Bucket=ORDER_SNAPSHOT_BUCKET, Key=order_snapshot_name(table_name))['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    return pickle.loads(body)
+
+def save_order_snapshot(table_name, snapshot):
+    boto3.client('s3').put_object(Bucket=ORDER_SNAPSHOT_BUCKET, Key=order_snapshot_name(table_name), Body=pickle.dumps(snapshot))
+
+def drop_order_snapshot(table_name):
+    boto3.client('s3').delete_object(Bucket=ORDER_SNAPSHOT_BUCKET, Key=order_snapshot_name(table_name))
+
+def load_orders(orders_df, table_name, aws_schema, engine, mode=None):
+    mode = mode or ORDER_LOAD_MODE
+    if mode == 'delta':
+        load_orders_delta(orders_df, table_name, aws_schema, engine)
+    elif mode == 'window':
+        load_orders_window(orders_df, table_name, aws_schema, engine)
+    elif mode == 'open_year':
+        load_orders_open_year(orders_df, table_name, aws_schema, engine)
+    else:
+        load_orders_full(orders_df, table_name, aws_schema, engine)
+
+def load_orders_full(orders_df, table_name, aws_schema, engine):
+    upload_csv_to_s3(orders_df, table_name+'order_info.csv')
+
+    query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_orders"
+    query_copy = copy_from_s3(aws_schema + "." + table_name + "_orders", table_name+'order_info.csv')
+    conn = engine.connect()
+
+    conn.execute(text(query_delete).execution_options(autocommit=True))
+
+    conn.execute(text(query_copy).execution_options(autocommit=True))
+    conn.close()
+    # The table now matches the sheet exactly, so the next delta load can start from here
+    save_order_snapshot(table_name, order_snapshot(orders_df))
+
+def load_orders_delta(orders_df, table_name, aws_schema, engine):
+    # Reload only the (date, discount_code) groups whose rows changed since the last load. Keys and rows go to temp
+    # staging tables, then the matching warehouse rows are deleted and the staged rows inserted in one transaction.
+    previous = load_order_snapshot(table_name)
+    if previous is None:
+        print ('{} INFO: load_orders_delta - No snapshot for table {}, running a full load'.format(datetime.datetime.now(), table_name))
+        load_orders_full(orders_df, table_name, aws_schema, engine)
+        return
+
+    current = order_snapshot(orders_df)
+    compared = previous.join(current, how='outer', lsuffix='_previous')
+    changed = (compared['rows'] != compared['rows_previous']) | (compared['lo'] != compared['lo_previous']) | (compared['hi'] != compared['hi_previous'])
+    changed_keys = compared.index[changed.values]
+    if len(changed_keys) == 0:
+        print ('{} INFO: load_orders_delta - No order rows changed for table {}'.format(datetime.datetime.now(), table_name))
+        return
+
+    changed_rows = orders_df[order_keys(orders_df).isin(changed_keys).values]
+    print ('{} INFO: load_orders_delta - Table {}: {} changed key(s), {} row(s) to insert'.format(datetime.datetime.now(), table_name, len(changed_keys), len(changed_rows)))
+    upload_csv_to_s3(pd.DataFrame({'order_key': changed_keys}), table_name+'order_keys.csv')
+    upload_csv_to_s3(changed_rows, table_name+'order_info.csv')
+
+    target = aws_schema + "." + table_name + "_orders"
+    with engine.begin() as conn:
+        conn.execute(text("""CREATE TEMP TABLE stage_order_keys (order_key VARCHAR(65535))"""))
+        conn.execute(text("""CREATE TEMP TABLE stage_orders (LIKE """ + target + """)"""))
+        conn.execute(text(copy_from_s3("stage_order_keys", table_name+'order_keys.csv')))
+        conn.execute(text(copy_from_s3("stage_orders", table_name+'order_info.csv')))
+        conn.execute(text("""DELETE FROM """ + target + """ USING stage_order_keys
+            WHERE coalesce(to_char(""" + target + """.date, 'YYYY-MM-DD'), '') || '|' || coalesce(""" + target + """.discount_code, '') = stage_order_keys.order_key"""))
+        conn.execute(text("""INSERT INTO """ + target + """ SELECT * FROM stage_orders"""))
+        conn.execute(text("""DROP TABLE stage_order_keys"""))
+        conn.execute(text("""DROP TABLE stage_orders"""))
+    save_order_snapshot(table_name, current)
+
+def load_orders_window(orders_df, table_name, aws_schema, engine, days=ORDER_WINDOW_DAYS):
+    # Replace only the rows dated within the last days, older rows in the warehouse are left alone until the next
+    # full reload
+    cutoff = pd.Timestamp(datetime.date.today() - datetime.timedelta(days=days))
+    window_df = orders_df[orders_df['date'] >= cutoff]
+    print ('{} INFO: load_orders_window - Table {}: reloading {} row(s) dated from {}'.format(datetime.datetime.now(), table_name, len(window_df), cutoff.date()))
+    upload_csv_to_s3(window_df, table_name+'order_info.csv')
+
+    target = aws_schema + "." + table_name + "_orders"
+    with engine.begin() as conn:
+        conn.execute(text("""DELETE FROM """ + target + """ WHERE date >= '""" + cutoff.strftime('%Y-%m-%d') + """'"""))
+        conn.execute(text(copy_from_s3(target, table_name+'order_info.csv')))
+    # Rows outside the window may now differ from the sheet, the next delta load has to start from a full load
+    drop_order_snapshot(table_name)
+
+def open_year_start():
+    return pd.Timestamp(datetime.date(datetime.date.today().year, 1, 1))
+
+def open_year_start_utc():
+    # Local midnight of January 1, as naive UTC like the other stored timestamps
+    return datetime.datetime(datetime.date.today().year, 1, 1).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+def load_orders_open_year(orders_df, table_name, aws_schema, engine):
+    # Replace the open year (and undated rows, which every reload replaced before) and never touch closed years.
+    # orders_df only needs to hold "Current Year Orders", rows from closed years in it are ignored.
+    start = open_year_start()
+    open_df = orders_df[(orders_df['date'] >= start) | orders_df['date'].isna()]
+    print ('{} INFO: load_orders_open_year - Table {}: reloading {} row(s) dated from {}'.format(datetime.datetime.now(), table_name, len(open_df), start.date()))
+    upload_csv_to_s3(open_df, table_name+'order_info.csv')
+
+    target = aws_schema + "." + table_name + "_orders"
+    with engine.begin() as conn:
+        conn.execute(text("""DELETE FROM """ + target + """ WHERE date >= '""" + start.strftime('%Y-%m-%d') + """' OR date IS NULL"""))
+        conn.execute(text(copy_from_s3(target, table_name+'order_info.csv')))
+    drop_order_snapshot(table_name)
+
+def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomendation,ctx):
     print ('{} INFO: order_upload - Starting...'.format(datetime.datetime.now()))
     # recomendation_and_promo_code_addition(order_url_for_matching=order_url,json_data_input=go,table_name_for_matching=table_name,adjusted_client=adj_cli)
     # add_new_order_sheet(order_url,json_data_input=go,table_name_for_matching=table_name,adjusted_client=adj_cli)
@@ -189,156 +870,139 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
 
         try:
             start = time.time()
-            json_datas = go
-            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-            client = gspread.authorize(creds)
-            engine=create_engine(post)
+            engine=get_engine()
             # print('getting data from gsheet')
-            sheet = client.open_by_url(order_url).worksheet("Promo Codes")
-
-            #sheet = workbook.worksheet("Potential Errors")
+            # Header rows in one call, then one batchGet of just the columns this load needs
+            spreadsheet_id = spreadsheet_id_from_url(order_url)
+            orders_load_mode = ctx.orders_load_mode()
+            # Closed years are already in the warehouse, an open year load has no use for "Historical Orders"
+            order_tabs = ["Current Year Orders"] if orders_load_mode == 'open_year' else ["Current Year Orders", "Historical Orders"]
+            workbook_frames = read_order_workbook(spreadsheet_id, dict([("Promo Codes", PROMO_COLUMNS)] + [(tab, ORDER_COLUMN_COUNT) for tab in order_tabs]))
 
-            #sheet = workbook.worksheet("Promo Codes")
-            promo_list = sheet.get_all_values()
-            promo_df = pd.DataFrame(promo_list[1:],columns=promo_list[0])
+            promo_df = workbook_frames["Promo Codes"]
+            promo_fingerprint = frame_fingerprint(promo_df)
 
-            sheet.update_acell('B1', """=ARRAYFORMULA(IF(ROW(B1:B) = 1,"Vendor ID",iferror(IF(A1:A <> "",IFERROR(VLOOKUP(AF1:AF,'Link to Market Info'!A:M,13,False),IFERROR(VLOOKUP(A1:A,'Link to Market Info'!B:M,12,False), iferror(VLOOKUP(A1:A,'Link to Market Info'!F:M,8,FALSE),(VLOOKUP(A1:A,'Link to Market Info - Local Radio'!B:D,3,FALSE))))),""),AF1:AF)))""")
+            ensure_vendor_id_formula(spreadsheet_id)
 
             #Load All Data after 8:00 p.m.
-            sheet_curr = client.open_by_url(order_url).worksheet("Current Year Orders")
-            orders_list_curr = sheet_curr.get_all_values()
-            orders_df_curr = pd.DataFrame(orders_list_curr[1:],columns=orders_list_curr[0])
-
-
-            sheet_hist = client.open_by_url(order_url).worksheet("Historical Orders")
-            orders_list_hist = sheet_hist.get_all_values()
-            orders_df_hist = pd.DataFrame(orders_list_hist[1:],columns=orders_list_hist[0])
-
-            orders_df = pd.concat([orders_df_curr, orders_df_hist],sort=False)
-
-
-            orders_df.columns = orders_df_curr.columns
-            orders_df.replace("",np.NaN,inplace=True)
-
-            for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
-                orders_df[column] = orders_df[column].apply(lambda x: x.replace(',','').replace("$","") if type(x) == str else np.NaN)
-                orders_df[column] = orders_df[column].astype(float)
-
-            orders_df['date'] = pd.to_datetime(orders_df['date'])
-
-            orders_df.columns = ['date','discount_code','client_name','orders','conversions','revenue','session','downloads_installs',
-                                'discounts','lead_impressions','users','new_users','approvals','funded_loans_amounts','tracking_type',
-                                'product_type','lead_impression_type','unattributed_orders','session_type','code_leak_date','extra_1',
-                                'extra_2','extra_3']
-            if new_table == True:
-            #    print('hey new table')
-                data_type = {'date':DATETIME,
-                             'discount_code':VARCHAR,
-                             'client_name':VARCHAR,
-                             'orders':FLOAT,
-                             'conversions':FLOAT,
-                             'revenue':FLOAT,
-                             'session':FLOAT,
-                             'downloads_installs':FLOAT,
-                             'discounts':FLOAT,
-                             'lead_impressions':FLOAT,
-                             'users':FLOAT,
-                             'new_users':FLOAT,
-                             'approvals':FLOAT,
-                             'funded_loans_amounts':FLOAT,
-                             'tracking_type':VARCHAR,
-                             'product_type':VARCHAR,
-                             'lead_impression_type':VARCHAR,
-                             'unattributed_orders':FLOAT,
-                             'session_type':VARCHAR,
-                             'code_leak_date':DATETIME,
-                             'extra_1':FLOAT,
-                             'extra_2':FLOAT,
-                             'extra_3':FLOAT}
-
-                top_orders = orders_df.head(1)
-                try:
-                    top_orders.to_sql( table_name + "_orders",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
-                except:
-                    x = 1
-            orders_df.to_csv(table_name+'order_info.csv',index=False)
-            session = boto3.Session()
-            s3 = session.resource("s3")
-            s3.meta.client.upload_file(table_name+'order_info.csv','adresults',table_name+'order_info.csv')
-            os.remove(table_name+'order_info.csv')
-            #  print('done')
-
-            query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_orders"
-
-            query_copy = """copy """ + aws_schema + "." + table_name + "_orders" + """
-            from 's3://adresults/""" + table_name+"""order_info.csv'
-            credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
-            IGNOREHEADER 1
-            EMPTYASNULL
-            csv;"""
-            # print('starting upload')
-            conn = engine.connect()
-
-            conn.execute(text(query_delete).execution_options(autocommit=True))
-
-            conn.execute(text(query_copy).execution_options(autocommit=True))
-            conn.close()
+            orders_df_curr = workbook_frames["Current Year Orders"]
+
+            orders_fingerprints = dict((tab, frame_fingerprint(workbook_frames[tab])) for tab in order_tabs)
+            if ctx.tabs_unchanged(orders_fingerprints) and not ctx.orders_reconcile_due and orders_load_mode == ORDER_LOAD_MODE:
+                print ('{} INFO: order_upload - Order tabs unchanged since last import, skipping orders load for table {}'.format(datetime.datetime.now(), table_name))
+            else:
+                orders_df = pd.concat([workbook_frames[tab] for tab in order_tabs],sort=False)
+
+
+                orders_df.columns = orders_df_curr.columns
+                orders_df.replace("",np.NaN,inplace=True)
+
+                convert_order_dates(orders_df)
+                for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
+                    orders_df[column] = parse_currency_column(orders_df[column], keep_numbers=ORDER_TYPED_READS)
+
+                orders_df['date'] = pd.to_datetime(orders_df['date'])
+
+                orders_df.columns = ['date','discount_code','client_name','orders','conversions','revenue','session','downloads_installs',
+                                    'discounts','lead_impressions','users','new_users','approvals','funded_loans_amounts','tracking_type',
+                                    'product_type','lead_impression_type','unattributed_orders','session_type','code_leak_date','extra_1',
+                                    'extra_2','extra_3']
+                if ctx.new_table == True:
+                #    print('hey new table')
+                    data_type = {'date':DATETIME,
+                                 'discount_code':VARCHAR,
+                                 'client_name':VARCHAR,
+                                 'orders':FLOAT,
+                                 'conversions':FLOAT,
+                                 'revenue':FLOAT,
+                                 'session':FLOAT,
+                                 'downloads_installs':FLOAT,
+                                 'discounts':FLOAT,
+                                 'lead_impressions':FLOAT,
+                                 'users':FLOAT,
+                                 'new_users':FLOAT,
+                                 'approvals':FLOAT,
+                                 'funded_loans_amounts':FLOAT,
+                                 'tracking_type':VARCHAR,
+                                 'product_type':VARCHAR,
+                                 'lead_impression_type':VARCHAR,
+                                 'unattributed_orders':FLOAT,
+                                 'session_type':VARCHAR,
+                                 'code_leak_date':DATETIME,
+                                 'extra_1':FLOAT,
+                                 'extra_2':FLOAT,
+                                 'extra_3':FLOAT}
+
+                    top_orders = orders_df.head(1)
+                    try:
+                        top_orders.to_sql( table_name + "_orders",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
+                    except:
+                        x = 1
+                load_orders(orders_df, table_name, aws_schema, engine, orders_load_mode)
+                ctx.orders_loaded(orders_load_mode)
+                ctx.tab_fingerprints.update(orders_fingerprints)
             # s3.Object('adresults',table_name+'order_info.csv').delete()
             # print('done done')
 
             promo_df.replace('',np.NaN,inplace=True)
             promo_df.replace("#N/A",np.NaN,inplace=True)
 
-            promo_df = promo_df[['Show Name', 'Vendor ID', "Client", 'Promo Code', 'Budget Show Name', 'Unique Code', 'Code Leak Date']]
+            promo_df = promo_df[PROMO_COLUMNS]
 
             promo_df.columns = ['show_name','vendor_id','client','promo_code','budget_show_name','unique_code','code_leak_date']
+            if ORDER_TYPED_READS:
+                promo_df['code_leak_date'] = serial_number_to_datetime(promo_df['code_leak_date'])
 
             promo_df['vendor_id'] = pd.Series(promo_df['vendor_id'],dtype ='Int64')
-            if new_table == True:
-                #   print('hey new table')
-                data_type = {
-                    'show_name':VARCHAR,
-                    'vendor_id': INTEGER,
-                    'client':VARCHAR,
-                    'promo_code':VARCHAR,
-                    'budget_show_name':VARCHAR,
-                    'unique_code':VARCHAR,
-                    'code_leak_date':DATETIME
-                }
-
-                top_promo = promo_df.head(1)
-                try:
-                    top_promo.to_sql(table_name + "_promo_codes",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
-                except:
-                    x = 1
-            promo_df.to_csv(table_name + '.csv',index=False)
-
-            session = boto3.Session()
-            s3 = session.resource("s3")
-            s3.meta.client.upload_file(table_name + '.csv','adresults',table_name + '.csv')
-
             missing_vendor_id = str(promo_df['vendor_id'].isna().sum())
             total_number = str(len(promo_df))
-            # print('done')
-            os.remove(table_name + '.csv')
-            engine=create_engine(post)
-
-            query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_promo_codes"
-
-            query_copy = """copy """ + aws_schema + "." + table_name + "_promo_codes" + """
-            from 's3://adresults/""" + table_name +""".csv'
-            credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
-            IGNOREHEADER 1
-            EMPTYASNULL
-            csv;"""
-            #print('starting upload')
-            conn = engine.connect()
-
-            conn.execute(text(query_delete).execution_options(autocommit=True))
-
-            conn.execute(text(query_copy).execution_options(autocommit=True))
-            conn.close()
+            promo_fingerprints = {"Promo Codes": promo_fingerprint}
+            if ctx.tabs_unchanged(promo_fingerprints):
+                print ('{} INFO: order_upload - Promo Codes tab unchanged since last import, skipping promo code load for table {}'.format(datetime.datetime.now(), table_name))
+            else:
+                if ctx.new_table == True:
+                    #   print('hey new table')
+                    data_type = {
+                        'show_name':VARCHAR,
+                        'vendor_id': INTEGER,
+                        'client':VARCHAR,
+                        'promo_code':VARCHAR,
+                        'budget_show_name':VARCHAR,
+                        'unique_code':VARCHAR,
+                        'code_leak_date':DATETIME
+                    }
+
+                    top_promo = promo_df.head(1)
+                    try:
+                        top_promo.to_sql(table_name + "_promo_codes",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
+                    except:
+                        x = 1
+                promo_df.to_csv(table_name + '.csv',index=False)
+
+                session = boto3.Session()
+                s3 = session.resource("s3")
+                s3.meta.client.upload_file(table_name + '.csv','adresults',table_name + '.csv')
+
+                # print('done')
+                os.remove(table_name + '.csv')
+                engine=get_engine()
+
+                query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_promo_codes"
+
+                query_copy = """copy """ + aws_schema + "." + table_name + "_promo_codes" + """
+                from 's3://adresults/""" + table_name +""".csv'
+                credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
+                IGNOREHEADER 1
+                EMPTYASNULL
+                csv;"""
+                #print('starting upload')
+                conn = engine.connect()
+
+                conn.execute(text(query_delete).execution_options(autocommit=True))
+
+                conn.execute(text(query_copy).execution_options(autocommit=True))
+                conn.close()
+                ctx.tab_fingerprints.update(promo_fingerprints)
             #s3.Object('adresults',table_name + '.csv').delete()
             #print('done done')
             if recomendation == True:
@@ -350,11 +1014,11 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
                 #missing_number = add_missing_promo_codes(order_url_for_matching=order_url,json_data_input=go,table_name_for_matching=table_name,adjusted_client=adj_cli)
 
             #Only Update input tabs if data available
-            if len(non_local_radio_ids) > 0:
-                update_non_local_radio_tab(order_url)
+            if len(ctx.non_local_radio_ids) > 0:
+                update_non_local_radio_tab(order_url, ctx)
 
-            if len(local_radio_ids) > 0:
-                update_local_radio_tab(order_url)
+            if len(ctx.local_radio_ids) > 0:
+                update_local_radio_tab(order_url, ctx)
 
             #non_local_radio_ids)
 
@@ -368,9 +1032,9 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
             total_time = minutes + seconds
 
             print ('{} INFO: Done with table {} - Total Time: {}'.format(datetime.datetime.now(), table_name, total_time))            
-            error_list.append(table_name + " completed successfully \n " + "Number of New Promo Codes: " + missing_number + "\n" + "Number of Missing Vendor ID's: " + missing_vendor_id + " out of " + total_number + "\n"+ order_url)
+            ctx.error_list.append(table_name + " completed successfully \n " + "Number of New Promo Codes: " + missing_number + "\n" + "Number of Missing Vendor ID's: " + missing_vendor_id + " out of " + total_number + "\n"+ order_url)
         except Exception as e:
-            error_list.append(table_name + " has errored: " + str(e) + "\n" + order_url)
+            ctx.error_list.append(table_name + " has errored: " + str(e) + "\n" + order_url)
             print ('{} ERROR: Error will processing table {}'.format(datetime.datetime.now(), table_name))
             print ('{} ERROR: {}'.format(datetime.datetime.now(), e))
 
@@ -381,179 +1045,145 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
         try:
 
             start = time.time()
-            json_datas = go
-            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(json_datas,scope)
-            client = gspread.authorize(creds)
-            engine=create_engine(post)
+            engine=get_engine()
             # print('getting data from gsheet')
-            sheet = client.open_by_url(order_url).worksheet("Promo Codes")
-
-            # sheet = workbook.worksheet("Potential Errors")
-
-            # sheet = workbook.worksheet("Promo Codes")
-            promo_list = sheet.get_all_values()
-            promo_df = pd.DataFrame(promo_list[1:],columns=promo_list[0])
-
-            sheet.update_acell('B1', """=ARRAYFORMULA(IF(ROW(B1:B) = 1,"Vendor ID",iferror(IF(A1:A <> "",IFERROR(VLOOKUP(AF1:AF,'Link to Market Info'!A:M,13,False),IFERROR(VLOOKUP(A1:A,'Link to Market Info'!B:M,12,False), iferror(VLOOKUP(A1:A,'Link to Market Info'!F:M,8,FALSE),(VLOOKUP(A1:A,'Link to Market Info - Local Radio'!B:D,3,FALSE))))),""),AF1:AF)))""")
-
-            # sheet = client.open_by_url(order_url).worksheet("Orders")
-
-            # orders_list = sheet.get_all_values()
-            # orders_df = pd.DataFrame(orders_list[1:],columns=orders_list[0])
-
-            # Load All Data after 8:00 p.m.
-
-            sheet_curr = client.open_by_url(order_url).worksheet("Current Year Orders")
-            orders_list_curr = sheet_curr.get_all_values()
-            orders_df_curr = pd.DataFrame(orders_list_curr[1:],columns=orders_list_curr[0])
-
-            orders_df_curr.replace("",np.NaN,inplace=True)
-
-            for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
-                orders_df_curr[column] = orders_df_curr[column].apply(lambda x: x.replace(',','').replace("$","") if type(x) == str else np.NaN)
-                orders_df_curr[column] = orders_df_curr[column].astype(float)
-
-            # select * from production.client_order_data.ava_science_orders where date <= '1/1/2020'
-            # sheet_hist = client.open_by_url(order_url).worksheet("Historical Orders")
-            # orders_list_hist = sheet_hist.get_all_values()
-            # orders_df_hist = pd.DataFrame(orders_list_hist[1:],columns=orders_list_hist[0])
-            # print("""select * from production.client_order_data.""" + table_name + """_orders where date < '1/1/2020'""")
-            engine = create_engine(post)
-            orders_df_hist = pd.read_sql("""select * from production.client_order_data.""" + table_name + """_orders where date_part('year', date) < date_part('year', current_date)""",engine)
-
-            orders_df = pd.concat([orders_df_curr, orders_df_hist],sort=False)
-
-            orders_df.columns = orders_df_curr.columns
-            # orders_df.replace("",np.NaN,inplace=True)
-
-            orders_df['date'] = pd.to_datetime(orders_df['date'])
-
-            # for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
-            # orders_df[column] = orders_df[column].apply(lambda x: x.replace(',','').replace("$","") if type(x) == str else np.NaN)
-            # orders_df[column] = orders_df[column].astype(float)
-
-            orders_df.columns = ['date','discount_code','client_name','orders','conversions','revenue','session','downloads_installs',
-                    'discounts','lead_impressions','users','new_users','approvals','funded_loans_amounts','tracking_type',
-                    'product_type','lead_impression_type','unattributed_orders','session_type','code_leak_date','extra_1',
-                    'extra_2','extra_3']
-
-            if new_table == True:
-                # print('hey new table')
-                data_type = {'date':DATETIME,
-                             'discount_code':VARCHAR,
-                             'client_name':VARCHAR,
-                             'orders':FLOAT,
-                             'conversions':FLOAT,
-                             'revenue':FLOAT,
-                             'session':FLOAT,
-                             'downloads_installs':FLOAT,
-                             'discounts':FLOAT,
-                             'lead_impressions':FLOAT,
-                             'users':FLOAT,
-                             'new_users':FLOAT,
-                             'approvals':FLOAT,
-                             'funded_loans_amounts':FLOAT,
-                             'tracking_type':VARCHAR,
-                             'product_type':VARCHAR,
-                             'lead_impression_type':VARCHAR,
-                             'unattributed_orders':FLOAT,
-                             'session_type':VARCHAR,
-                             'code_leak_date':DATETIME,
-                             'extra_1':FLOAT,
-                             'extra_2':FLOAT,
-                             'extra_3':FLOAT}
-
-                top_orders = orders_df.head(1)
-                try:
-                    top_orders.to_sql( table_name + "_orders",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
-                except:
-                    x = 1
-
-            # print(orders_df)
-
-            orders_df.to_csv(table_name+'order_info.csv',index=False)
-            session = boto3.Session()
-
-            s3 = session.resource("s3")
-            s3.meta.client.upload_file(table_name+'order_info.csv','adresults',table_name+'order_info.csv')
-            os.remove(table_name+'order_info.csv')
+            # Header rows in one call, then one batchGet of just the columns this load needs
+            spreadsheet_id = spreadsheet_id_from_url(order_url)
+            orders_load_mode = ctx.orders_load_mode()
+            # Closed years are already in the warehouse, an open year load has no use for "Historical Orders"
+            order_tabs = ["Current Year Orders"] if orders_load_mode == 'open_year' else ["Current Year Orders", "Historical Orders"]
+            workbook_frames = read_order_workbook(spreadsheet_id, dict([("Promo Codes", PROMO_COLUMNS)] + [(tab, ORDER_COLUMN_COUNT) for tab in order_tabs]))
 
-            # print('done')
+            promo_df = workbook_frames["Promo Codes"]
+            promo_fingerprint = frame_fingerprint(promo_df)
 
-            query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_orders"
+            ensure_vendor_id_formula(spreadsheet_id)
 
-            #print(query_delete)
-            query_copy = """copy """ + aws_schema + "." + table_name + "_orders" + """
-            from 's3://adresults/""" + table_name+"""order_info.csv'
-            credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
-            IGNOREHEADER 1
-            EMPTYASNULL
-            csv;"""
+            orders_df_curr = workbook_frames["Current Year Orders"]
 
-            # print(query_copy)
-            # print('starting upload')
-            conn = engine.connect()
-
-            conn.execute(text(query_delete).execution_options(autocommit=True))
-
-            conn.execute(text(query_copy).execution_options(autocommit=True))
-            conn.close()
+            orders_fingerprints = dict((tab, frame_fingerprint(workbook_frames[tab])) for tab in order_tabs)
+            if ctx.tabs_unchanged(orders_fingerprints) and not ctx.orders_reconcile_due and orders_load_mode == ORDER_LOAD_MODE:
+                print ('{} INFO: order_upload - Order tabs unchanged since last import, skipping orders load for table {}'.format(datetime.datetime.now(), table_name))
+            else:
+                orders_df = pd.concat([workbook_frames[tab] for tab in order_tabs],sort=False)
+                orders_df.columns = orders_df_curr.columns
+                orders_df.replace("",np.NaN,inplace=True)
+
+                convert_order_dates(orders_df)
+                for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
+                    orders_df[column] = parse_currency_column(orders_df[column], keep_numbers=ORDER_TYPED_READS)
+                # orders_df.replace("",np.NaN,inplace=True)
+
+                orders_df['date'] = pd.to_datetime(orders_df['date'])
+
+                # for column in ['orders', 'conversions','revenue', 'session', 'downloads_installs', 'discounts','lead_impressions', 'users', 'new_users', 'approvals','funded_loans_amounts',"extra_1","extra_2"]:
+                # orders_df[column] = orders_df[column].apply(lambda x: x.replace(',','').replace("$","") if type(x) == str else np.NaN)
+                # orders_df[column] = orders_df[column].astype(float)
+
+                orders_df.columns = ['date','discount_code','client_name','orders','conversions','revenue','session','downloads_installs',
+                        'discounts','lead_impressions','users','new_users','approvals','funded_loans_amounts','tracking_type',
+                        'product_type','lead_impression_type','unattributed_orders','session_type','code_leak_date','extra_1',
+                        'extra_2','extra_3']
+
+                if ctx.new_table == True:
+                    # print('hey new table')
+                    data_type = {'date':DATETIME,
+                                 'discount_code':VARCHAR,
+                                 'client_name':VARCHAR,
+                                 'orders':FLOAT,
+                                 'conversions':FLOAT,
+                                 'revenue':FLOAT,
+                                 'session':FLOAT,
+                                 'downloads_installs':FLOAT,
+                                 'discounts':FLOAT,
+                                 'lead_impressions':FLOAT,
+                                 'users':FLOAT,
+                                 'new_users':FLOAT,
+                                 'approvals':FLOAT,
+                                 'funded_loans_amounts':FLOAT,
+                                 'tracking_type':VARCHAR,
+                                 'product_type':VARCHAR,
+                                 'lead_impression_type':VARCHAR,
+                                 'unattributed_orders':FLOAT,
+                                 'session_type':VARCHAR,
+                                 'code_leak_date':DATETIME,
+                                 'extra_1':FLOAT,
+                                 'extra_2':FLOAT,
+                                 'extra_3':FLOAT}
+
+                    top_orders = orders_df.head(1)
+                    try:
+                        top_orders.to_sql( table_name + "_orders",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
+                    except:
+                        x = 1
+
+                # print(orders_df)
+
+                load_orders(orders_df, table_name, aws_schema, engine, orders_load_mode)
+                ctx.orders_loaded(orders_load_mode)
+                ctx.tab_fingerprints.update(orders_fingerprints)
             # s3.Object('adresults',table_name+'order_info.csv').delete()
             # print('done done')
 
             promo_df.replace('',np.NaN,inplace=True)
             promo_df.replace("#N/A",np.NaN,inplace=True)
 
-            promo_df = promo_df[['Show Name', 'Vendor ID', "Client", 'Promo Code', 'Budget Show Name', 'Unique Code', 'Code Leak Date']]
+            promo_df = promo_df[PROMO_COLUMNS]
 
             promo_df.columns = ['show_name','vendor_id','client','promo_code','budget_show_name','unique_code','code_leak_date']
+            if ORDER_TYPED_READS:
+                promo_df['code_leak_date'] = serial_number_to_datetime(promo_df['code_leak_date'])
 
             promo_df['vendor_id'] = pd.Series(promo_df['vendor_id'],dtype ='Int64')
-            if new_table == True:
-                # print('hey new table')
-                data_type = {
-                    'show_name':VARCHAR,
-                    'vendor_id': INTEGER,
-                    'client':VARCHAR,
-                    'promo_code':VARCHAR,
-                    'budget_show_name':VARCHAR,
-                    'unique_code':VARCHAR,
-                    'code_leak_date':DATETIME
-                }
-
-                top_promo = promo_df.head(1)
-                try:
-                    top_promo.to_sql(table_name + "_promo_codes",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
-                except:
-                    x = 1
-            promo_df.to_csv(table_name + '.csv',index=False)
-
-            session = boto3.Session()
-            s3 = session.resource("s3")
-            s3.meta.client.upload_file(table_name + '.csv','adresults',table_name + '.csv')
-
             missing_vendor_id = str(promo_df['vendor_id'].isna().sum())
             total_number = str(len(promo_df))
-            # print('done')
-            os.remove(table_name + '.csv')
-            engine=create_engine(post)
-
-            query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_promo_codes"
-
-            query_copy = """copy """ + aws_schema + "." + table_name + "_promo_codes" + """
-            from 's3://adresults/""" + table_name +""".csv'
-            credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
-            IGNOREHEADER 1
-            EMPTYASNULL
-            csv;"""
-            # print('starting upload')
-            conn = engine.connect()
-
-            conn.execute(text(query_delete).execution_options(autocommit=True))
-
-            conn.execute(text(query_copy).execution_options(autocommit=True))
-            conn.close()
+            promo_fingerprints = {"Promo Codes": promo_fingerprint}
+            if ctx.tabs_unchanged(promo_fingerprints):
+                print ('{} INFO: order_upload - Promo Codes tab unchanged since last import, skipping promo code load for table {}'.format(datetime.datetime.now(), table_name))
+            else:
+                if ctx.new_table == True:
+                    # print('hey new table')
+                    data_type = {
+                        'show_name':VARCHAR,
+                        'vendor_id': INTEGER,
+                        'client':VARCHAR,
+                        'promo_code':VARCHAR,
+                        'budget_show_name':VARCHAR,
+                        'unique_code':VARCHAR,
+                        'code_leak_date':DATETIME
+                    }
+
+                    top_promo = promo_df.head(1)
+                    try:
+                        top_promo.to_sql(table_name + "_promo_codes",engine,schema=aws_schema,if_exists='fail',index=False,dtype=data_type)
+                    except:
+                        x = 1
+                promo_df.to_csv(table_name + '.csv',index=False)
+
+                session = boto3.Session()
+                s3 = session.resource("s3")
+                s3.meta.client.upload_file(table_name + '.csv','adresults',table_name + '.csv')
+
+                # print('done')
+                os.remove(table_name + '.csv')
+                engine=get_engine()
+
+                query_delete = """TRUNCATE """ + aws_schema + "." + table_name + "_promo_codes"
+
+                query_copy = """copy """ + aws_schema + "." + table_name + "_promo_codes" + """
+                from 's3://adresults/""" + table_name +""".csv'
+                credentials 'aws_access_key_id=""" + acc + """;aws_secret_access_key=""" + sh + """'
+                IGNOREHEADER 1
+                EMPTYASNULL
+                csv;"""
+                # print('starting upload')
+                conn = engine.connect()
+
+                conn.execute(text(query_delete).execution_options(autocommit=True))
+
+                conn.execute(text(query_copy).execution_options(autocommit=True))
+                conn.close()
+                ctx.tab_fingerprints.update(promo_fingerprints)
             # s3.Object('adresults',table_name + '.csv').delete()
             # print('done done')
             if recomendation == True:
@@ -565,11 +1195,11 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
                 # missing_number = add_missing_promo_codes(order_url_for_matching=order_url,json_data_input=go,table_name_for_matching=table_name,adjusted_client=adj_cli)
 
             # Only Update input tabs if data available
-            if len(non_local_radio_ids) > 0:
-                update_non_local_radio_tab(order_url)
+            if len(ctx.non_local_radio_ids) > 0:
+                update_non_local_radio_tab(order_url, ctx)
 
-            if len(local_radio_ids) > 0:
-                update_local_radio_tab(order_url)
+            if len(ctx.local_radio_ids) > 0:
+                update_local_radio_tab(order_url, ctx)
 
 
             # non_local_radio_ids)
@@ -584,73 +1214,284 @@ def order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomend
             total_time = minutes + seconds
 
             print ('{} INFO: Done with table {} - Total Time: {}'.format(datetime.datetime.now(), table_name, total_time))
-            error_list.append(table_name + " completed successfully \n " + "Number of New Promo Codes: " + missing_number + "\n" + "Number of Missing Vendor ID's: " + missing_vendor_id + " out of " + total_number + "\n"+ order_url)
+            ctx.error_list.append(table_name + " completed successfully \n " + "Number of New Promo Codes: " + missing_number + "\n" + "Number of Missing Vendor ID's: " + missing_vendor_id + " out of " + total_number + "\n"+ order_url)
         except Exception as e:
-            error_list.append(table_name + " has errored: " + str(e) + "\n" + order_url)
+            ctx.error_list.append(table_name + " has errored: " + str(e) + "\n" + order_url)
             print ('{} ERROR: Error while processing table {}'.format(datetime.datetime.now(), table_name))
             print ('{} ERROR: {}'.format(datetime.datetime.now(), e))
     print ('{} INFO: order_upload - Done'.format(datetime.datetime.now()))
 
-def importSheet(gSheet):
-    global local_radio_ids
-    global non_local_radio_ids
-    global range_string
-    global range_string_2
-    global df_as_list_2
-    global df_as_list
-
+def importSheet(gSheet, checkpoint=None):
     print ('{} INFO: importSheet - Starting...'.format(datetime.datetime.now()))
     start = time.time()
-    engine = create_engine(post)
-
-    local_radio_ids = pd.read_sql("""SELECT client_name,combined,date_added,pseudo_vendor_id FROM matt_testing.local_radio_pseudo_id""",engine)
-
-    print ('{} INFO: importSheet - About to make df_as_list'.format(datetime.datetime.now()))
-    df_as_list = ["client_name","combined","date_added","pseudo_vendor_id"]
-    for row in range(len(local_radio_ids)):
-        str_list = ["" if pd.isnull(x) else float(x) if type(x) == np.float64 else int(x) if type(x) == np.int64 else str(x) for x in list(local_radio_ids.iloc[row])]
-        df_as_list += str_list
-    range_string = "A1:D"+ str(len(local_radio_ids) + 1)
-    
-    non_local_radio_ids = pd.read_sql("""select vendor_id, station_name, market_name, Media_Type, Adjusted_Market_Name, Adjusted_Show_Name, Genre_itunes, Genre_ARM, Subgenre_iTunes, Subgenre_ARM, Itunes_URL, Unique_show_flag, Master_vendor_id from production.gsheet.unique_shows""",engine)
-
-    print ('{} INFO: importSheet - About to make df_as_list_2'.format(datetime.datetime.now()))
-    df_as_list_2 = ["vendor_id","station_name","market_name","Media_Type","Adjusted_Market_Name","Adjusted_Show_Name","Genre_itunes","Genre_ARM","Subgenre_iTunes","Subgenre_ARM","Itunes_URL","Unique_show_flag","Master_vendor_id"]
-    for row in range(len(non_local_radio_ids)):
-        str_list_2 = ["" if pd.isnull(x) else float(x) if type(x) == np.float64 else int(x) if type(x) == np.int64 else str(x) for x in list(non_local_radio_ids.iloc[row])]
-        df_as_list_2 += str_list_2
-    range_string_2 = "A1:M"+ str(len(non_local_radio_ids) + 1)
+    ctx = ImportContext(gSheet, checkpoint)
+
+    # Market Info tab contents are the same for every client, shared across imports through the reference cache
+    localRadio = get_reference_cache().get('local_radio')
+    ctx.local_radio_ids = localRadio['frame']
+    ctx.local_radio_values = localRadio['values']
+
+    uniqueShows = get_reference_cache().get('unique_shows')
+    ctx.non_local_radio_ids = uniqueShows['frame']
+    ctx.unique_shows_values = uniqueShows['values']
 
     gSheetID = gSheet.get(GSHEET_ID_ATTRIBUTE)
     gSheetName = gSheet.get(GSHEET_NAME_ATTRIBUTE)
     gSheetModifiedTime = gSheet.get(GSHEET_MODIFIED_TIME_ATTRIBUTE)
 
-    # Open the client list JSON filename with mappings
-    client_list_file_path = client_list_file_dir + "/" + client_list_file_name
-    with open(client_list_file_path) as client_list_file:
-        print ('{} INFO: importSheet - Loading client list from {}...'.format(datetime.datetime.now(), client_list_file_name))
-        client_list = json.load(client_list_file)
-
     order_url = ''
-    for client in client_list:
-        if debug: print ('{} DEBUG: importSheet - client metadata {}'.format(datetime.datetime.now(), client))
-        if gSheetID in client.get('order_url'):
-            order_url = client.get('order_url')
-            active_client = client.get('active_client')
-            table_name = client.get('table_name')
-            adj_cli = client.get('adj_cli')
-            aws_schema = 'client_order_data'
-            recomendation = client.get('recomendation')
-            print ('{} INFO: importSheet - Found metadata for client {}, please wait...'.format(datetime.datetime.now(), adj_cli))
-            break          
+    client = get_client_registry().find(gSheetID)
+    if client is not None:
+        if debug: print ('{} DEBUG: importSheet - client metadata {}'.format(datetime.datetime.now(), dict(client)))
+        order_url = client.get('order_url')
+        active_client = client.get('active_client')
+        table_name = client.get('table_name')
+        adj_cli = client.get('adj_cli')
+        aws_schema = 'client_order_data'
+        recomendation = client.get('recomendation')
+        print ('{} INFO: importSheet - Found metadata for client {}, please wait...'.format(datetime.datetime.now(), adj_cli))
 
     if order_url:
         print ('{} INFO: importSheet - Loading data for table {}, please wait...'.format(datetime.datetime.now(), table_name))
         if adj_cli == "Crossrope" or adj_cli == "23andMe":
-            order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomendation)
+            order_upload(order_url,active_client,table_name,adj_cli ,aws_schema,recomendation,ctx)
         print ('{} INFO: importSheet - Done'.format(datetime.datetime.now()))
     else:
         print ('{} INFO: importSheet - No metadata found for gSheet {}, skipping import...'.format(datetime.datetime.now(), gSheetName))
+    return ctx
+
+def listGSheetIDs(service):
+    gSheetIDs = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q = "'" + GOOGLE_DRIVE_FOLDER_ID + "' in parents and mimeType = '" + GSHEET_MIME_TYPE + "'",
+            includeItemsFromAllDrives = True,
+            supportsAllDrives = True,
+            pageSize = DRIVE_CHANGES_PAGE_SIZE,
+            fields='nextPageToken, files(id)',
+            pageToken=page_token).execute()
+        gSheetIDs += [file.get(GSHEET_ID_ATTRIBUTE) for file in response.get('files', [])]
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            return gSheetIDs
+
+def watchChannelToken(channelID):
+    # Drive echoes the channel token in X-Goog-Channel-Token on every notification. It is signed with the service
+    # account key so only Drive (and --notify, which has the same credentials) can produce it for a channel ID.
+    return hmac.new(GOOGLE_SERVICE_ACCOUNT_INFO['private_key'].encode('utf-8'), channelID.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def watchGSheet(service, gSheetID):
+    channelID = str(uuid.uuid4())
+    expiration = int((time.time() + WATCH_CHANNEL_TTL_SECONDS) * 1000)
+    if WEBHOOK_ADDRESS:
+        channel = service.files().watch(
+            fileId = gSheetID,
+            supportsAllDrives = True,
+            body = {
+                'id': channelID,
+                'type': 'web_hook',
+                'address': WEBHOOK_ADDRESS,
+                'token': watchChannelToken(channelID),
+                'expiration': expiration,
+            }).execute()
+    else:
+        # Local test mode, nothing is registered with Drive and only --notify posts to this channel
+        channel = {'id': channelID, 'expiration': str(expiration), 'local': True}
+    channel['token'] = watchChannelToken(channelID)
+    print ("{} INFO: watchGSheet - Watching gSheet {} on {}channel {}".format(datetime.datetime.now(), gSheetID, 'local test ' if channel.get('local') else '', channelID))
+    return channel
+
+def findWatchedGSheet(channelID, token):
+    # gSheet ID of the registered channel matching a notification's channel ID and token, None for anything else
+    if not channelID or not token:
+        return None
+    with _watchChannelsLock:
+        for gSheetID, channel in _watchChannels.items():
+            if channel.get('id') == channelID and hmac.compare_digest(channel.get('token', ''), token):
+                return gSheetID
+    return None
+
+def stopWatchChannel(service, channel):
+    if channel.get('local'):
+        return
+    try:
+        service.channels().stop(body = {
+            'id': channel.get('id'),
+            'resourceId': channel.get('resourceId'),
+        }).execute()
+    except Exception as e:
+        print ("{} ERROR: stopWatchChannel - Unable to stop channel {}: {}".format(datetime.datetime.now(), channel.get('id'), e))
+
+def renewWatchChannels():
+    # Register a channel for every gSheet in the folder that has none or whose channel expires soon,
+    # then stop the replaced channels and those of sheets no longer in the folder
+    if not WEBHOOK_ADDRESS:
+        print ("{} WARNING: renewWatchChannels - WEBHOOK_ADDRESS is not set, registering local test channels only".format(datetime.datetime.now()))
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+    gSheetIDs = listGSheetIDs(service)
+    renewBefore = (time.time() + WATCH_CHANNEL_RENEW_SECONDS) * 1000
+    renewed = 0
+
+    for gSheetID in gSheetIDs:
+        with _watchChannelsLock:
+            channel = _watchChannels.get(gSheetID)
+        if channel is not None and int(channel.get('expiration', 0)) > renewBefore:
+            continue
+        try:
+            newChannel = watchGSheet(service, gSheetID)
+        except Exception as e:
+            print ("{} ERROR: renewWatchChannels - Unable to watch gSheet {}: {}".format(datetime.datetime.now(), gSheetID, e))
+            continue
+        with _watchChannelsLock:
+            _watchChannels[gSheetID] = newChannel
+        if channel is not None:
+            stopWatchChannel(service, channel)
+        renewed += 1
+
+    with _watchChannelsLock:
+        removedGSheetIDs = [gSheetID for gSheetID in _watchChannels if gSheetID not in gSheetIDs]
+        removedChannels = [_watchChannels.pop(gSheetID) for gSheetID in removedGSheetIDs]
+    for channel in removedChannels:
+        stopWatchChannel(service, channel)
+    print ("{} INFO: renewWatchChannels - Renewed {} channel(s), stopped {}, watching {} gSheet(s)".format(datetime.datetime.now(), renewed, len(removedChannels), len(gSheetIDs)))
+
+def stopWatchChannels():
+    service = get_google_service('drive', 'v3', GOOGLE_SERVICE_ACCOUNT_INFO, SCOPES)
+    with _watchChannelsLock:
+        channels = list(_watchChannels.values())
+        _watchChannels.clear()
+    for channel in channels:
+        stopWatchChannel(service, channel)
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    # Drive posts an empty body, everything we need is in the X-Goog-* headers. A 'sync' message is sent once
+    # when a channel is created and carries no change. Posts that do not match a channel we registered are
+    # rejected without touching Drive or the checkpoint store.
+    def do_POST(self):
+        gSheetID = findWatchedGSheet(self.headers.get('X-Goog-Channel-ID'), self.headers.get('X-Goog-Channel-Token'))
+        resourceState = self.headers.get('X-Goog-Resource-State')
+        if gSheetID is None:
+            print ("{} WARNING: NotificationHandler - Rejected notification from {} for unknown channel {}".format(datetime.datetime.now(), self.client_address[0], self.headers.get('X-Goog-Channel-ID')))
+            self.send_response(403)
+            self.end_headers()
+            return
+        if resourceState not in ('sync', 'trash', 'remove'):
+            if debug: print ("{} DEBUG: NotificationHandler - {} notification for gSheet {}".format(datetime.datetime.now(), resourceState, gSheetID))
+            _notificationQueue.put(gSheetID)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if debug: print ("{} DEBUG: NotificationHandler - {}".format(datetime.datetime.now(), format % args))
+
+def startWebhookReceiver(host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    server = ThreadingHTTPServer((host, port), NotificationHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    print ("{} INFO: startWebhookReceiver - Listening for Drive notifications on {}:{}".format(datetime.datetime.now(), host, port))
+    return server
+
+def processNotifications(stopEvent, max_workers=IMPORT_MAX_WORKERS):
+    # Wait for notified gSheet IDs, collect the burst that follows for WEBHOOK_DEBOUNCE_SECONDS and import them
+    while not stopEvent.is_set():
+        try:
+            gSheetIDs = [_notificationQueue.get(timeout=1)]
+        except queue.Empty:
+            continue
+        stopEvent.wait(WEBHOOK_DEBOUNCE_SECONDS)
+        while True:
+            try:
+                gSheetIDs.append(_notificationQueue.get_nowait())
+            except queue.Empty:
+                break
+        gSheetIDs = list(dict.fromkeys(gSheetIDs))
+        print ("{} INFO: processNotifications - Received notifications for {} gSheet(s)".format(datetime.datetime.now(), len(gSheetIDs)))
+        try:
+            gSheets = getSheets(gSheetIDs)
+            processGSheets([gSheets[gSheetID] for gSheetID in gSheetIDs if gSheetID in gSheets], max_workers)
+        except Exception as e:
+            print ("{} ERROR: processNotifications - {}".format(datetime.datetime.now(), e))
+
+def sendTestNotification(channelID, url='http://localhost:{}/'.format(WEBHOOK_PORT), resourceState='update'):
+    # Local stand-in for Drive, posts the same headers a files.watch channel would. channelID has to be one the
+    # receiver registered (logged by watchGSheet), anything else is rejected with a 403. Without WEBHOOK_ADDRESS the
+    # daemon registers local test channels only, so this is enough to exercise the whole path locally.
+    request = urllib.request.Request(url, data=b'', method='POST', headers={
+        'X-Goog-Channel-ID': channelID,
+        'X-Goog-Channel-Token': watchChannelToken(channelID),
+        'X-Goog-Resource-ID': 'test',
+        'X-Goog-Resource-State': resourceState,
+        'X-Goog-Message-Number': '1',
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def runDaemon(poll_interval=DAEMON_POLL_INTERVAL_SECONDS, max_workers=IMPORT_MAX_WORKERS, webhook=False):
+    # Run runScan every poll_interval seconds in this process so credentials, API clients and the engine stay
+    # warm between ticks. SIGTERM/SIGINT let the current tick finish and then exit.
+    # With webhook=True Drive push notifications drive the imports, each tick also renews the watch channels
+    # and the scan only acts as a safety net for missed notifications.
+    stopEvent = threading.Event()
+    server = None
+    notificationThread = None
+
+    def stop(signum, frame):
+        print ("{} INFO: runDaemon - Received signal {}, stopping after the current tick".format(datetime.datetime.now(), signum))
+        stopEvent.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print ("{} INFO: runDaemon - Starting with a poll interval of {} seconds".format(datetime.datetime.now(), poll_interval))
+    if webhook:
+        server = startWebhookReceiver()
+        notificationThread = Thread(target=processNotifications, args=[stopEvent, max_workers])
+        notificationThread.start()
+
+    while not stopEvent.is_set():
+        tickStart = time.time()
+        if webhook:
+            try:
+                renewWatchChannels()
+            except Exception as e:
+                print ("{} ERROR: runDaemon - Watch channel renewal failed: {}".format(datetime.datetime.now(), e))
+        try:
+            runScan(max_workers=max_workers)
+        except Exception as e:
+            print ("{} ERROR: runDaemon - Scan failed: {}".format(datetime.datetime.now(), e))
+        stopEvent.wait(max(0, poll_interval - (time.time() - tickStart)))
+
+    if server is not None:
+        server.shutdown()
+    if notificationThread is not None:
+        # Let an import that is already running finish its loads before the process exits
+        print ("{} INFO: runDaemon - Waiting for notification imports to finish".format(datetime.datetime.now()))
+        notificationThread.join()
+    if server is not None:
+        stopWatchChannels()
+    print ("{} INFO: runDaemon - Stopped".format(datetime.datetime.now()))
 
 if __name__ == '__main__':
-    scanGDrive()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Import client gSheets that changed since the last run')
+    parser.add_argument('--full-scan', action='store_true', help='List every gSheet in the Drive folder instead of reading the changes feed')
+    parser.add_argument('--checkpoint-store', choices=['dynamodb', 'sqlite'], default=CHECKPOINT_BACKEND, help='Where last seen modified times are kept')
+    parser.add_argument('--max-workers', type=int, default=IMPORT_MAX_WORKERS, help='Maximum number of gSheets imported in parallel')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and scan every --poll-interval seconds')
+    parser.add_argument('--poll-interval', type=int, default=None, help='Seconds between scans in daemon mode')
+    parser.add_argument('--webhook', action='store_true', help='Daemon mode driven by Drive push notifications (local test channels only without WEBHOOK_ADDRESS)')
+    parser.add_argument('--order-load-mode', choices=ORDER_LOAD_MODES, default=ORDER_LOAD_MODE, help='How changed order tabs are written to the warehouse')
+    parser.add_argument('--notify', metavar='CHANNEL_ID', help='Post a test notification for a registered watch channel to a local webhook receiver and exit')
+    args = parser.parse_args()
+    CHECKPOINT_BACKEND = args.checkpoint_store
+    ORDER_LOAD_MODE = args.order_load_mode
+    if args.notify:
+        print ("{} INFO: Test notification returned {}".format(datetime.datetime.now(), sendTestNotification(args.notify)))
+    elif args.webhook:
+        runDaemon(poll_interval=args.poll_interval or WEBHOOK_POLL_INTERVAL_SECONDS, max_workers=args.max_workers, webhook=True)
+    elif args.daemon:
+        runDaemon(poll_interval=args.poll_interval or DAEMON_POLL_INTERVAL_SECONDS, max_workers=args.max_workers)
+    else:
+        runScan(full_scan=args.full_scan, max_workers=args.max_workers)
\ No newline at end of file
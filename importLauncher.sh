@@ -11,9 +11,11 @@ if [[ ${PID} ]]; then
   echo "$(date) INFO: Found existing process running ${PID}. Exiting..."
   exit 0
 else
-  echo "$(date) INFO: Starting ${launchScript}."
+  # Any arguments are passed through, e.g. "importLauncher.sh --daemon" keeps a single long-running scanner
+  # alive and the process check above stops cron from starting a second copy.
+  echo "$(date) INFO: Starting ${launchScript} $@."
   cmd="${launchDir}/${launchScript}"
-  $cmd & 
+  $cmd "$@" & 
 fi
 
 exit 0
\ No newline at end of file